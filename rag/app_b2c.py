@@ -1,32 +1,78 @@
 import os
+import asyncio
+import math
+import logging
 import uvicorn
 import uuid
+import hashlib
+from typing import Optional
 from datetime import datetime
 from langchain_community.callbacks import get_openai_callback
-from langchain_core.messages import message_to_dict
-
-from fastapi.responses import JSONResponse
-from fastapi import Depends, FastAPI, Body, HTTPException, status
+from langchain_core.messages import AIMessage, HumanMessage, message_to_dict
+
+from fastapi.responses import JSONResponse, PlainTextResponse
+from fastapi import (
+    BackgroundTasks,
+    Depends,
+    FastAPI,
+    Body,
+    Header,
+    HTTPException,
+    Request,
+    status,
+)
 from fastapi.middleware.cors import CORSMiddleware
-
-from rag.utils import format_package_data, sentence_transformer_ef
-from rag.auth import decode_token
+from opentelemetry import trace
+
+from rag.utils import format_package_data
+from rag.auth import decode_token, jwks_manager, require_admin
+from rag.timing import ServerTimingMiddleware, stage
+from rag.profiling import ProfilingMiddleware, RequestProfiler
+from rag.tracing import configure_tracing
+from rag.metrics import metrics_app
+from rag.query_stats import query_stats
 from rag.query import QueryConversations
 from rag.config import (
     ChatQuestion,
     Postgres,
     ConversationUpdateRequest,
     VectorDatabaseFilter,
+    PromptBudgetConfig,
+    LLMGatewayConfig,
+    WriteBehindConfig,
+    ProfilerConfig,
+    TracingConfig,
+    RetrievalServiceConfig,
+)
+from rag.chatbot.memory import (
+    PostgresChatMessageHistory,
+    PostgresSummaryBufferMemory,
+    WriteBehindMessageStore,
+)
+from rag.chatbot.llm import (
+    LangChainChatbot,
+    CachedTokensCallbackHandler,
+    TracingCallbackHandler,
+    LLMGateway,
+    LLMOverloadedError,
 )
-from rag.chatbot.memory import PostgresChatMessageHistory
-from rag.chatbot.llm import LangChainChatbot
 from rag.chatbot.retriever import VectorZurichChromaDbClient
-from rag.constants import DB_PATH, COLLECTION_NAME
+from rag.chatbot.reranker import CrossEncoderReranker
+from rag.chatbot.context import ContextAssembler
+from rag.chatbot.prompt import PromptBuilder
+from rag.chatbot.singleflight import SingleFlight
+from rag.constants import (
+    DB_PATH,
+    COLLECTION_NAME,
+    CONTEXT_STATIC_GENERAL_CONDITION,
+)
 from dotenv import load_dotenv
 
 load_dotenv()
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
+logger = logging.getLogger(__name__)
+
 
 # Create an instance of the Postgres class
 postgres_instance = Postgres()
@@ -38,19 +84,90 @@ conn_string = postgres_instance.postgre_url
 query_db = QueryConversations(connection_string=conn_string)
 
 
-chroma_collection: VectorZurichChromaDbClient = (
-    VectorZurichChromaDbClient.get_retriever(
+# The shared retrieval service if configured, else the models and the index
+# are loaded in this process
+retrieval_service_config = RetrievalServiceConfig.load_from_env()
+if retrieval_service_config.enabled:
+    chroma_collection = VectorZurichChromaDbClient.from_service(
+        retrieval_service_config
+    )
+else:
+    from rag.utils import sentence_transformer_ef
+
+    # Optional cross-encoder rerank stage after the vector retrieval
+    reranker = (
+        CrossEncoderReranker()
+        if os.getenv("RERANK_ENABLED", "false").lower() == "true"
+        else None
+    )
+
+    chroma_collection = VectorZurichChromaDbClient.get_retriever(
         collection_name=COLLECTION_NAME,
         db_path=DB_PATH,
         embeddings=sentence_transformer_ef,
+        reranker=reranker,
     )
-)
 
-# The langchain chain
-chain = LangChainChatbot.rag_from_config(
+# The langchain chain, hedged with failover when several backends are set,
+# e.g. LLM_BACKENDS="azure:./azure_config.yml,openai:./openai_config.yml"
+llm_backends = [
+    tuple(backend.strip().split(":", 1))
+    for backend in os.getenv("LLM_BACKENDS", "").split(",")
+    if backend.strip()
+]
+if len(llm_backends) > 1:
+    chain = LangChainChatbot.hedged_from_config(backends=llm_backends)
+else:
+    api_type, config_path = (llm_backends or [("openai", "./openai_config.yml")])[0]
+    chain = LangChainChatbot.rag_from_config(config_path=config_path, api_type=api_type)
+
+# Admission control of the LLM calls
+llm_gateway = LLMGateway.from_config(LLMGatewayConfig.load_from_env())
+
+# The chain folding older messages into the conversation summaries
+summarizer = LangChainChatbot.summarizer_from_config(
     config_path="./openai_config.yml", api_type="openai"
 )
 
+# Removes the redundant chunks from the context of the chain. With a static
+# general condition, the whole of it is kept (a prefix cached by the
+# provider) instead of its chunks selected with MMR
+static_general_condition = os.getenv(
+    "CONTEXT_STATIC_GENERAL_CONDITION", str(CONTEXT_STATIC_GENERAL_CONDITION)
+)
+context_assembler = ContextAssembler(
+    model=chain.last.model_name,
+    static_general_condition=static_general_condition.lower() == "true",
+)
+
+# Fits the prompt of the chain in the token budget
+prompt_builder = PromptBuilder(
+    prompt=chain.first,
+    model=chain.last.model_name,
+    budget=PromptBudgetConfig.load_from_env(),
+)
+
+# Writes the chat messages in the background, off the latency path. Until
+# they are written, only the /chat of this worker sees them
+message_store = WriteBehindMessageStore(
+    connection_string=conn_string,
+    table_name=os.getenv("TABLE_NAME_CONVERSATION_MESSAGES"),
+    **WriteBehindConfig.load_from_env().model_dump(),
+)
+
+
+def preload():
+    """Loads the Chroma index and the general condition before the workers are
+    forked by `rag.serve`, so that they share them."""
+    chroma_collection.warm_up()
+
+
+# Coalesces the duplicates of the in-flight chat requests
+chat_single_flight = SingleFlight()
+
+# Samples the stacks of the requests sent with an `X-Profile` header by an admin
+request_profiler = RequestProfiler(ProfilerConfig.load_from_env())
+
 # FastApi app
 app = FastAPI()
 
@@ -63,89 +180,264 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Per stage timings of the requests, in the Server-Timing header
+app.add_middleware(ServerTimingMiddleware)
+
+# On-demand profiling of single requests
+app.add_middleware(ProfilingMiddleware, profiler=request_profiler)
+
+# OpenTelemetry spans of the requests, exported if `TRACING_EXPORTER` is set
+tracer_provider = configure_tracing(TracingConfig.load_from_env(), app=app)
+
+# Prometheus metrics
+app.mount("/metrics", metrics_app())
+
+
+@app.on_event("startup")
+def start_message_store():
+    message_store.start()
+
+
+@app.on_event("shutdown")
+def stop_message_store():
+    # Flushes the pending messages before the process exits
+    message_store.stop()
+
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await LangChainChatbot.close_http_client()
+    await jwks_manager.stop()
+
+
+@app.on_event("shutdown")
+def flush_traces():
+    if tracer_provider is not None:
+        tracer_provider.shutdown()
+
 
 @app.post("/chat")
-async def chat(question: ChatQuestion = Body(...), playload=Depends(decode_token)):
+async def chat(
+    background_tasks: BackgroundTasks,
+    question: ChatQuestion = Body(...),
+    idempotency_key: Optional[str] = Header(default=None),
+    playload=Depends(decode_token),
+):
+
+    request_span = trace.get_current_span()
+    request_span.set_attribute("enduser.id", playload["sub"])
+    request_span.set_attribute("conversation.uuid", question.conversation_uuid)
 
     # Check if the user is the owner of the conversation.
-    if not query_db.user_owns_conversation(
-        user_uuid=playload["sub"], conversation_uuid=question.conversation_uuid
-    ):
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="User does not have the rights to access this conversation",
-        )
-    
-    # user package_info
-    user_package = query_db.get_user_packages(user_uuid=str(playload["sub"]))
-    list_user_packages, deductible_info, sum_insured_info = format_package_data(
-        data=user_package
+    with stage("ownership"):
+        if not query_db.user_owns_conversation(
+            user_uuid=playload["sub"], conversation_uuid=question.conversation_uuid
+        ):
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="User does not have the rights to access this conversation",
+            )
+
+    # Duplicates of an in-flight question (double-clicks, client retries)
+    # share its response, and only one turn is persisted. A finished response
+    # is only reused by the retries carrying its Idempotency-Key: the same
+    # short reply ("oui") sent twice in a row is two turns
+    coalesce_key = (
+        question.conversation_uuid,
+        hashlib.sha256(question.question.encode("utf-8")).hexdigest(),
+        idempotency_key,
+    )
+    # Only the response data is kept for the retries, not the memories holding
+    # the Postgres connection of the conversation
+    response_data, shared = await chat_single_flight.do(
+        coalesce_key,
+        lambda: answer_question(
+            question=question,
+            user_id=playload["sub"],
+            background_tasks=background_tasks,
+        ),
+        keep_result=idempotency_key is not None,
     )
 
-    # chat memory
-    chat_memory = PostgresChatMessageHistory(
-        conversation_uuid=question.conversation_uuid,
+    request_span.set_attribute("chat.coalesced", shared)
+
+    # By default the chat history only holds the new turn, the client has the
+    # earlier messages. Built per request, as the coalesced duplicates may
+    # ask for another history
+    if question.full_history or question.since_message_id is not None:
+        with stage("chat_history"):
+            chat_history_dict = await asyncio.to_thread(
+                read_chat_history,
+                question.conversation_uuid,
+                after_id=None if question.full_history else question.since_message_id,
+                until_id=response_data["last_message_id"],
+            )
+            response_data = {**response_data, "chat_history": chat_history_dict}
+
+    return JSONResponse(
+        content=response_data,
+        status_code=200,
+        headers={"X-Coalesced": str(shared).lower()},
+    )
+
+
+def open_chat_memory(conversation_uuid: str) -> PostgresChatMessageHistory:
+    return PostgresChatMessageHistory(
+        conversation_uuid=conversation_uuid,
         connection_string=conn_string,
         table_name=os.getenv("TABLE_NAME_CONVERSATION_MESSAGES"),
+        write_behind=message_store,
     )
-    # chat history for prompt
-    chat_history_prompt = chat_memory.messages[-2 * 2 :]
 
-    # chat history for json response
-    chat_history_dict = [message_to_dict(message) for message in chat_memory.messages]
+
+def read_chat_history(conversation_uuid: str, after_id=None, until_id=None):
+    """Messages of the conversation, on a connection closed once read"""
+    chat_memory = open_chat_memory(conversation_uuid)
+    try:
+        return chat_memory.get_message_dicts(after_id=after_id, until_id=until_id)
+    finally:
+        chat_memory.connection.close()
+
+
+async def answer_question(
+    question: ChatQuestion, user_id: str, background_tasks: BackgroundTasks
+):
+    """Answers the question, persists the turn and schedules the summary update
+    in `background_tasks`. Returns the response data."""
+    # user package_info
+    with stage("packages"):
+        user_package = query_db.get_user_packages(user_uuid=str(user_id))
+        list_user_packages, deductible_info, sum_insured_info = format_package_data(
+            data=user_package
+        )
+
+    with stage("history"):
+        # chat memory
+        chat_memory = open_chat_memory(question.conversation_uuid)
+        # The ids of the turn, allocated while the answer is generated
+        turn_message_ids = asyncio.ensure_future(
+            asyncio.to_thread(chat_memory.allocate_message_ids, 2)
+        )
+        # rolling summary and the messages not summarized yet, for prompt
+        summary_memory = PostgresSummaryBufferMemory(
+            chat_memory=chat_memory,
+            table_name=os.getenv(
+                "TABLE_NAME_CONVERSATION_SUMMARIES", "conversation_summaries"
+            ),
+        )
+        conversation_summary, chat_history_prompt = summary_memory.load()
 
     # Retriver filter
     user_filter = VectorDatabaseFilter(mapping_package=list_user_packages).filters()
 
     print(user_filter)
 
+    # Question embedding, shared by the retrieval and the context assembly
+    with stage("embedding"):
+        query_embedding = chroma_collection.embed_query(question.question)
+
     # User package
-    user_package_data_info, list_ids_retriver = (
-        chroma_collection.get_zurich_package_info(
-            filter_packages=user_filter, user_question=question.question, top_k=3
+    with stage("retrieval"):
+        package_chunks = chroma_collection.get_zurich_package_chunks(
+            filter_packages=user_filter,
+            user_question=question.question,
+            top_k=3,
+            query_embedding=query_embedding,
         )
-    )
-    
-    
+
     # General Condition
-    general_condition = chroma_collection.get_zurich_general_condition()
+    with stage("general_condition"):
+        general_condition_chunks = (
+            chroma_collection.get_zurich_general_condition_chunks()
+        )
 
-    # Context for the LLM
-    context = (
-        f"{user_package_data_info}\nThe insurance general condition:{general_condition}"
-    )
+    # Context for the LLM, without the redundant chunks
+    with stage("prompt"):
+        context, general_condition, context_stats = context_assembler.assemble(
+            query_embedding=query_embedding,
+            package_chunks=package_chunks,
+            general_chunks=general_condition_chunks,
+        )
 
-    # Request LLM
-    with get_openai_callback() as cb:
-        res = chain.invoke(
+        # Prompt variables, fitted in the token budget
+        prompt_variables, prompt_tokens = prompt_builder.build(
             {
                 "question": question.question,
                 "chat_history": chat_history_prompt,
+                "conversation_summary": conversation_summary,
                 "deductible": deductible_info,
                 "sum_insured": sum_insured_info,
                 "context": context,
+                "general_condition": general_condition,
             }
         )
 
-    # Add human message to the DB
-    chat_memory.add_user_message(
-        message=question.question, tokens=cb.prompt_tokens, cost=cb.total_cost
+    # Request LLM, once admitted by the gateway
+    cache_cb = CachedTokensCallbackHandler()
+    try:
+        with stage("llm"), get_openai_callback() as cb:
+            res = await llm_gateway.ainvoke(
+                chain,
+                prompt_variables,
+                user_id=user_id,
+                config={"callbacks": [cache_cb, TracingCallbackHandler()]},
+            )
+    except LLMOverloadedError as e:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=str(e),
+            headers={"Retry-After": str(math.ceil(e.retry_after))},
+        )
+    logger.info(
+        "Prompt tokens: %d, served from the provider cache: %d",
+        cb.prompt_tokens,
+        cache_cb.cached_tokens,
     )
 
-    # Add AI message to the DB
-    chat_memory.add_ai_message(
-        message=res.content, tokens=cb.completion_tokens, cost=cb.total_cost
-    )
+    with stage("persistence"):
+        # Add the human and AI messages to the DB, written in the background.
+        # Spooled in a thread, off the event loop
+        turn = [
+            (HumanMessage(content=question.question), cb.prompt_tokens, cb.total_cost),
+            (AIMessage(content=res.content), cb.completion_tokens, cb.total_cost),
+        ]
+        question_message_id, response_message_id = await asyncio.to_thread(
+            chat_memory.add_messages_with_usage,
+            turn,
+            message_ids=await turn_message_ids,
+        )
+
+    # The new turn, the next `since_message_id` of the client
+    chat_history_dict = [
+        {
+            "id": question_message_id,
+            **message_to_dict(HumanMessage(content=question.question)),
+        },
+        {"id": response_message_id, **message_to_dict(AIMessage(content=res.content))},
+    ]
 
     response_data = {
         "question": question.question,
         "response": res.content,
         "chat_history": chat_history_dict,
+        "last_message_id": response_message_id,
         "total_tokens": cb.total_tokens,
         "total_cost": cb.total_cost,
+        "context_tokens_saved": context_stats["context_tokens_saved"],
+        "prompt_tokens": prompt_tokens,
+        "cached_prompt_tokens": cache_cb.cached_tokens,
     }
 
-    return JSONResponse(content=response_data, status_code=200)
+    # Fold the older messages into the summary once the response is sent,
+    # the summarizer admitted by the gateway like the answers
+    background_tasks.add_task(
+        summary_memory.update_summary,
+        summarizer,
+        gateway=llm_gateway,
+        user_id=user_id,
+    )
+
+    return response_data
 
 
 @app.post("/conversation")
@@ -170,8 +462,9 @@ async def create_new_conversation(playload=Depends(decode_token)):
         "conversation_uuid": "a1b2c3d4-e5f6-7890-g1h2-i3j4k5l6m7n8",
         "conversation_name": "conv_20230401_153045",
         "chat_history": [
-            {"user": "AI", "message": "Bienvenu chez Insurapolis, comment puis-je vous aider ?"}
+            {"id": 1, "type": "ai", "data": {"content": "Bienvenu chez Insurapolis, comment puis-je vous aider ?", "type": "ai", ...}}
         ],
+        "last_message_id": 1,
     }
     ```
 
@@ -199,15 +492,14 @@ async def create_new_conversation(playload=Depends(decode_token)):
             tokens=12,
         )
 
-        chat_history_dict = [
-            message_to_dict(message) for message in chat_memory.messages
-        ]
+        chat_history_dict = chat_memory.get_message_dicts()
 
         response_data = {
             "user_email": playload["email"],
             "conversation_uuid": conv_uuid,
             "conversation_name": conv_name,
             "chat_history": chat_history_dict,
+            "last_message_id": chat_history_dict[-1]["id"],
         }
 
         return JSONResponse(content=response_data, status_code=status.HTTP_200_OK)
@@ -498,5 +790,59 @@ async def get_user_tokens(playload=Depends(decode_token)):
     )
 
 
+@app.get("/admin/profiles/{profile_id}")
+async def get_profile(profile_id: str, request: Request, format: str = "speedscope"):
+    """Returns a request profile as a speedscope file or as collapsed stacks
+    (`format=collapsed`) for flamegraph.pl. Authorized like the profiled
+    requests: the bearer token of an admin (`require_admin`) or a signed
+    `X-Profile-Signature` header."""
+    if not await request_profiler.authorize(
+        request.headers, request.method, request.url.path
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="User does not have the rights to access the profiles",
+        )
+
+    profile = request_profiler.store.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+
+    if format == "collapsed":
+        return PlainTextResponse(profile.to_collapsed())
+    return JSONResponse(content=profile.to_speedscope(), status_code=200)
+
+
+@app.get("/admin/query-stats")
+async def get_query_stats(
+    sort: str = "total_time", limit: int = 50, playload=Depends(require_admin)
+):
+    """Returns the statistics of the SQL statements by fingerprint, sorted by
+    `total_time`, `mean_time`, `recent_mean_time`, `max_time`, `calls` or
+    `rows`."""
+    if sort not in (
+        "total_time",
+        "mean_time",
+        "recent_mean_time",
+        "max_time",
+        "calls",
+        "rows",
+    ):
+        raise HTTPException(status_code=400, detail=f"Invalid sort: {sort}")
+    return JSONResponse(
+        content={
+            "slow_query_threshold": query_stats.slow_query_threshold,
+            "statements": query_stats.snapshot(sort=sort, limit=limit),
+        },
+        status_code=200,
+    )
+
+
+@app.delete("/admin/query-stats")
+async def reset_query_stats(playload=Depends(require_admin)):
+    query_stats.reset()
+    return JSONResponse(content={"message": "Query statistics reset"}, status_code=200)
+
+
 if __name__ == "__main__":
     uvicorn.run("app_b2c:app", host="localhost", port=8001, reload=True)
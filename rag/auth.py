@@ -1,26 +1,52 @@
 import httpx
 import boto3
 import uuid
+import random
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
 from datetime import datetime, timezone
 import jwt
 import time
+from opentelemetry import trace
 from fastapi import HTTPException, Header, Depends, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import os
 from dotenv import load_dotenv
 
+from rag.timing import stage
+from rag.tracing import tracer
+
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 AWS_REGION = os.getenv("AWS_REGION")
 AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
 AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
 DYNAMO_DB_TABLE = os.getenv("DYNAMO_DB_TABLE")
+# Local DynamoDB stand-in (`rag.fakes.dynamodb`), AWS if unset
+DYNAMO_DB_ENDPOINT_URL = os.getenv("DYNAMO_DB_ENDPOINT_URL")
 USER_POOL_ID = os.getenv("USER_POOL_ID")
 CLIENT_ID = os.getenv("CLIENT_ID")
-COGNITO_ISSUER = f"https://cognito-idp.{AWS_REGION}.amazonaws.com/{USER_POOL_ID}"
-COGNITO_JWKS_URI = f"{COGNITO_ISSUER}/.well-known/jwks.json"
+# Overridable to test against a local JWKS stand-in (`rag.fakes.jwks`)
+COGNITO_ISSUER = os.getenv(
+    "COGNITO_ISSUER", f"https://cognito-idp.{AWS_REGION}.amazonaws.com/{USER_POOL_ID}"
+)
+COGNITO_JWKS_URI = os.getenv(
+    "COGNITO_JWKS_URI", f"{COGNITO_ISSUER}/.well-known/jwks.json"
+)
 
 CACHE_TIME = 86400  # seconds
+JWKS_REFRESH_INTERVAL = 3600  # seconds between background refreshes
+JWKS_MIN_REFRESH_INTERVAL = 30  # seconds between refreshes for unknown kids
+TOKEN_CACHE_SIZE = 10000  # verified tokens
+MANAGED_CLIENTS_CACHE_TIME = 300  # seconds
+MANAGED_CLIENTS_NEGATIVE_CACHE_TIME = 60  # seconds, users managing no client
+MANAGED_CLIENTS_CACHE_SIZE = 10000  # users
+# Cognito group of the users allowed to use the admin endpoints
+ADMIN_GROUP = os.getenv("ADMIN_GROUP", "admin")
 
 # DynamoDB
 session = boto3.Session(
@@ -28,73 +54,233 @@ session = boto3.Session(
     aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
     region_name=AWS_REGION,
 )
-dynamodb = session.resource("dynamodb")
+dynamodb = session.resource("dynamodb", endpoint_url=DYNAMO_DB_ENDPOINT_URL)
 table = dynamodb.Table(DYNAMO_DB_TABLE)
 
 # Cache
-jwks_cache = {"keys": None, "fetched_time": 0}
+# kid -> (JWK, parsed public key)
+public_key_cache = {}
+# token hash -> (kid, payload), until the token expires
+token_cache = OrderedDict()
+# (sub, email) -> (expiry, UUIDs of the managed clients)
+managed_clients_cache = OrderedDict()
+# (sub, email) -> DynamoDB query in progress
+managed_clients_queries = {}
 
 security = HTTPBearer()
 
 
+class UnknownKeyError(HTTPException):
+    def __init__(self):
+        super().__init__(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="JWK not found for given kid",
+        )
+
+
+class JWKSManager:
+    """
+    Keeps the JWKS of the user pool up to date.
+
+    The keys are fetched once, then refreshed by a background task every
+    `refresh_interval` seconds (the previous keys are kept if a refresh
+    fails, for up to `max_age` seconds). A token signed with an unknown kid,
+    e.g. after a key rotation, triggers an on-demand refresh, at most every
+    `min_refresh_interval` seconds. Concurrent refreshes share a single fetch,
+    over a persistent HTTP client.
+    """
+
+    def __init__(
+        self,
+        jwks_uri: str = COGNITO_JWKS_URI,
+        refresh_interval: float = JWKS_REFRESH_INTERVAL,
+        min_refresh_interval: float = JWKS_MIN_REFRESH_INTERVAL,
+        max_age: float = CACHE_TIME,
+    ):
+        self.jwks_uri = jwks_uri
+        self.refresh_interval = refresh_interval
+        self.min_refresh_interval = min_refresh_interval
+        self.max_age = max_age
+        self.keys = None
+        self.fetched_time = 0
+        # Of the last fetch, even failed, so that the unknown kids do not
+        # retry an unreachable JWKS on every request
+        self.attempt_time = 0
+        self._client = None
+        self._refreshing = None
+        self._background = None
+
+    async def _fetch(self) -> dict:
+        self.attempt_time = time.time()
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=10)
+        with tracer.start_as_current_span("auth.jwks_fetch") as span:
+            response = await self._client.get(self.jwks_uri)
+            response.raise_for_status()
+            self.keys = {key["kid"]: key for key in response.json()["keys"]}
+            span.set_attribute("jwks.keys", len(self.keys))
+        self.fetched_time = time.time()
+        logger.info("JWKS refreshed, %d keys", len(self.keys))
+        return self.keys
+
+    async def refresh(self) -> dict:
+        """Fetches the keys, or waits for the fetch in progress."""
+        if self._refreshing is None:
+            self._refreshing = asyncio.ensure_future(self._fetch())
+            self._refreshing.add_done_callback(self._refresh_done)
+        return await asyncio.shield(self._refreshing)
+
+    def _refresh_done(self, task: asyncio.Future):
+        self._refreshing = None
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("JWKS refresh failed: %s", task.exception())
+
+    async def _run(self):
+        while True:
+            # Jitter, so that the workers do not refresh together
+            await asyncio.sleep(self.refresh_interval * random.uniform(0.9, 1.1))
+            try:
+                await self.refresh()
+            except Exception:
+                # Logged by `_refresh_done`, the previous keys are kept
+                pass
+
+    def start(self):
+        """Starts the background refresh, if not started yet."""
+        if self._background is None or self._background.done():
+            self._background = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._background is not None:
+            self._background.cancel()
+            self._background = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def get_keys(self) -> dict:
+        """Returns the keys, fetched on first use or if too old."""
+        self.start()
+        if self.keys is None or time.time() - self.fetched_time > self.max_age:
+            return await self.refresh()
+        return self.keys
+
+    async def refresh_unknown_kid(self) -> dict:
+        """Refreshes the keys on an unknown kid, unless a fetch was attempted
+        less than `min_refresh_interval` seconds ago."""
+        if time.time() - self.attempt_time < self.min_refresh_interval:
+            return self.keys
+        return await self.refresh()
+
+
+jwks_manager = JWKSManager()
+
+
 async def fetch_cognito_keys():
-    if jwks_cache["keys"] and (time.time() - jwks_cache["fetched_time"] < CACHE_TIME):
-        return jwks_cache["keys"]
-    async with httpx.AsyncClient() as client:
-        response = await client.get(COGNITO_JWKS_URI)
-        response.raise_for_status()
-        jwks_cache["keys"] = {key["kid"]: key for key in response.json()["keys"]}
-        jwks_cache["fetched_time"] = time.time()
-    return jwks_cache["keys"]
+    return await jwks_manager.get_keys()
 
 
-async def decode_token(
-    credentials: HTTPAuthorizationCredentials = Depends(security),
-    keys=Depends(fetch_cognito_keys),
-):
-    token = credentials.credentials
+def get_public_key(kid: str, jwk: dict):
+    """Returns the parsed public key of the JWK, parsed again only if the JWK of
+    the kid changed."""
+    cached = public_key_cache.get(kid)
+    if cached is not None and cached[0] == jwk:
+        return cached[1]
+    public_key = jwt.algorithms.RSAAlgorithm.from_jwk(jwk)
+    public_key_cache[kid] = (jwk, public_key)
+    return public_key
 
-    try:
-        unverified_headers = jwt.get_unverified_header(token)
-
-        if unverified_headers["kid"] not in keys:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="JWK not found for given kid",
-            )
-        public_key = jwt.algorithms.RSAAlgorithm.from_jwk(
-            keys[unverified_headers["kid"]]
+
+def get_cached_payload(token_hash: str, keys: dict):
+    """Returns the payload of an already verified token, if it has not expired
+    and its key is still published."""
+    cached = token_cache.get(token_hash)
+    if cached is None:
+        return None
+    kid, payload = cached
+    if kid not in keys or datetime.now(timezone.utc).timestamp() > payload["exp"]:
+        token_cache.pop(token_hash, None)
+        return None
+    token_cache.move_to_end(token_hash)
+    return payload
+
+
+def cache_payload(token_hash: str, kid: str, payload: dict):
+    token_cache[token_hash] = (kid, payload)
+    token_cache.move_to_end(token_hash)
+    while len(token_cache) > TOKEN_CACHE_SIZE:
+        token_cache.popitem(last=False)
+
+
+def verify_token(token: str, keys: dict) -> dict:
+    """
+    Verifies the token against the JWKS and returns its payload.
+
+    The payloads of the verified tokens are cached until they expire, so that
+    the tokens reused by a session are only verified once.
+    """
+    token_hash = hashlib.sha256(token.encode("utf-8")).hexdigest()
+    payload = get_cached_payload(token_hash, keys)
+    trace.get_current_span().set_attribute("auth.cache_hit", payload is not None)
+    if payload is not None:
+        return dict(payload)
+
+    unverified_headers = jwt.get_unverified_header(token)
+
+    if unverified_headers["kid"] not in keys:
+        raise UnknownKeyError()
+    public_key = get_public_key(
+        unverified_headers["kid"], keys[unverified_headers["kid"]]
+    )
+    payload = jwt.decode(
+        token,
+        public_key,
+        algorithms=["RS256"],
+        audience=CLIENT_ID,
+        issuer=COGNITO_ISSUER,
+    )
+
+    # Additional payload validations
+    current_time = datetime.now(timezone.utc).timestamp()
+    if payload.get("exp") is None or current_time > payload["exp"]:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Token has expired, please re-login",
         )
-        payload = jwt.decode(
-            token,
-            public_key,
-            algorithms=["RS256"],
-            audience=CLIENT_ID,
-            issuer=COGNITO_ISSUER,
+
+    if payload.get("aud") != CLIENT_ID:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Invalid token: Incorrect audience",
         )
 
-        # Additional payload validations
-        current_time = datetime.now(timezone.utc).timestamp()
-        if payload.get("exp") is None or current_time > payload["exp"]:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Token has expired, please re-login",
-            )
+    if payload.get("iss") != COGNITO_ISSUER:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Invalid token: Incorrect issuer",
+        )
 
-        if payload.get("aud") != CLIENT_ID:
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="Invalid token: Incorrect audience",
-            )
+    cache_payload(token_hash, unverified_headers["kid"], payload)
+    return dict(payload)
 
-        if payload.get("iss") != COGNITO_ISSUER:
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="Invalid token: Incorrect issuer",
-            )
 
-        return payload
+async def decode_token(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    keys=Depends(fetch_cognito_keys),
+):
+    token = credentials.credentials
+
+    try:
+        with stage("auth"):
+            try:
+                return verify_token(token, keys)
+            except UnknownKeyError:
+                # The keys may have been rotated
+                keys = await jwks_manager.refresh_unknown_kid()
+                return verify_token(token, keys)
 
+    except HTTPException:
+        raise
     except jwt.ExpiredSignatureError:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Token has expired."
@@ -114,26 +300,129 @@ async def decode_token(
         )
 
 
-def user_can_manage_client(managed_client_uuid: uuid.UUID, user_sub: str, user_email: str):
+async def require_admin(playload=Depends(decode_token)):
+    if ADMIN_GROUP not in playload.get("cognito:groups", []):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="User does not have the rights to access this resource",
+        )
+    return playload
+
+
+async def require_managed_client(
+    client_uuid: uuid.UUID, playload=Depends(decode_token)
+):
+    """Dependency of the endpoints acting on a client (`client_uuid` path
+    parameter) on behalf of the user managing it, checked with the cached
+    `async_user_can_manage_client`."""
+    if not await async_user_can_manage_client(
+        client_uuid, playload["sub"], playload.get("email")
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="User does not have the rights to manage this client",
+        )
+    return playload
+
+
+def get_managed_clients(user_sub: str, user_email: str) -> frozenset:
     """
-    Check if the requester has the right to manage the specified user.
+    Queries DynamoDB for the UUIDs of the clients managed by the user.
     """
-
-    try:
+    with tracer.start_as_current_span("auth.managed_clients") as span:
         response = table.get_item(Key={"id": str(user_sub), "email": str(user_email)})
 
-        item = response.get("Item", None)
-        list_managed_user_dicts = item.get("managedUsers", None)
+        item = response.get("Item") or {}
+        list_managed_user_dicts = item.get("managedUsers") or []
+        span.set_attribute("auth.managed_clients", len(list_managed_user_dicts))
+
+    return frozenset(
+        uuid.UUID(user_dict["id"]) for user_dict in list_managed_user_dicts
+    )
+
+
+def get_cached_managed_clients(key: tuple):
+    cached = managed_clients_cache.get(key)
+    if cached is None:
+        return None
+    if cached[0] < time.monotonic():
+        managed_clients_cache.pop(key, None)
+        return None
+    managed_clients_cache.move_to_end(key)
+    return cached[1]
+
+
+def cache_managed_clients(key: tuple, managed_clients: frozenset):
+    # Users managing no client are cached for less time, to pick up new ones
+    ttl = (
+        MANAGED_CLIENTS_CACHE_TIME
+        if managed_clients
+        else MANAGED_CLIENTS_NEGATIVE_CACHE_TIME
+    )
+    managed_clients_cache[key] = (time.monotonic() + ttl, managed_clients)
+    managed_clients_cache.move_to_end(key)
+    while len(managed_clients_cache) > MANAGED_CLIENTS_CACHE_SIZE:
+        managed_clients_cache.popitem(last=False)
 
-        if list_managed_user_dicts:
-            # Convert list of dictionaries with user IDs to list of UUIDs
-            list_managed_user_uuids = [
-                uuid.UUID(user_dict["id"]) for user_dict in list_managed_user_dicts
-            ]
-            if managed_client_uuid in list_managed_user_uuids:
-                return True
 
+def invalidate_managed_clients(user_sub: str, user_email: str = None):
+    """
+    Drops the cached managed clients of the user, e.g. after they changed.
+    """
+    for key in list(managed_clients_cache):
+        if key[0] == str(user_sub) and user_email in (None, key[1]):
+            managed_clients_cache.pop(key, None)
+
+
+async def async_user_can_manage_client(
+    managed_client_uuid: uuid.UUID, user_sub: str, user_email: str
+) -> bool:
+    """
+    Check if the requester has the right to manage the specified user, without
+    blocking the event loop.
+
+    The managed clients of every user are cached, and the concurrent requests
+    of a user share the same DynamoDB query.
+    """
+    key = (str(user_sub), str(user_email))
+    managed_clients = get_cached_managed_clients(key)
+    if managed_clients is not None:
+        return managed_client_uuid in managed_clients
+
+    query = managed_clients_queries.get(key)
+    if query is None:
+        query = asyncio.ensure_future(
+            asyncio.to_thread(get_managed_clients, user_sub, user_email)
+        )
+        managed_clients_queries[key] = query
+        query.add_done_callback(lambda _: managed_clients_queries.pop(key, None))
+
+    try:
+        managed_clients = await asyncio.shield(query)
+    except Exception as e:
+        logger.error("Failed to query DynamoDB: %s", e)
         return False
+
+    cache_managed_clients(key, managed_clients)
+    return managed_client_uuid in managed_clients
+
+
+def user_can_manage_client(
+    managed_client_uuid: uuid.UUID, user_sub: str, user_email: str
+):
+    """
+    Check if the requester has the right to manage the specified user.
+    """
+    key = (str(user_sub), str(user_email))
+    managed_clients = get_cached_managed_clients(key)
+    if managed_clients is not None:
+        return managed_client_uuid in managed_clients
+
+    try:
+        managed_clients = get_managed_clients(user_sub, user_email)
     except Exception as e:
-        print("Failed to query DynamoDB:", str(e))
+        logger.error("Failed to query DynamoDB: %s", e)
         return False
+
+    cache_managed_clients(key, managed_clients)
+    return managed_client_uuid in managed_clients
@@ -0,0 +1,8 @@
+from typing import List
+
+import numpy as np
+
+
+def latency_percentiles(latencies: List[float]) -> dict:
+    """Returns the p50/p95/p99 of the latencies, in milliseconds."""
+    return {f"p{q}_ms": float(np.percentile(latencies, q) * 1000) for q in (50, 95, 99)}
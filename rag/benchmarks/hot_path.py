@@ -0,0 +1,233 @@
+"""Micro-benchmarks of the components on the hot path of `/chat`, with
+baselines and regression thresholds.
+
+Every benchmark is timed in isolation (auto-calibrated loops, several
+rounds). The regressions are checked on the fastest round, the least
+sensitive to the noise of the machine. `--save-baseline` stores the results as a
+JSON baseline; `--baseline` compares a run to it and exits with an error if
+a benchmark is slower than its baseline by more than its threshold (the
+`threshold` of the benchmark in the baseline file, `--threshold` otherwise).
+Baselines are machine specific: record them on the machine that checks them.
+
+Example:
+
+    python -m rag.benchmarks.hot_path --save-baseline hot_path_baseline.json
+    python -m rag.benchmarks.hot_path --baseline hot_path_baseline.json
+"""
+
+import sys
+import json
+import atexit
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from langchain_core.messages import (
+    AIMessage,
+    HumanMessage,
+    message_to_dict,
+    messages_from_dict,
+)
+
+from rag.constants import DB_PATH, COLLECTION_NAME
+
+HISTORY_LENGTHS = [10, 100, 1000]
+DEFAULT_THRESHOLD = 0.2  # 20% slower
+
+
+def timeit(fn: Callable, rounds: int = 7, min_round_time: float = 0.05) -> dict:
+    """Median, min and standard deviation of the time per call of `fn`, in
+    microseconds."""
+    fn()  # warm-up
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        if time.perf_counter() - start >= min_round_time:
+            break
+        loops *= 2
+
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        times.append((time.perf_counter() - start) / loops * 1e6)
+    return {
+        "median_us": statistics.median(times),
+        "min_us": min(times),
+        "stdev_us": statistics.stdev(times),
+        "loops": loops,
+        "rounds": rounds,
+    }
+
+
+def make_history(length: int) -> List[dict]:
+    """Records of a conversation, as stored in the messages table."""
+    messages = []
+    for i in range(length):
+        message_class = HumanMessage if i % 2 == 0 else AIMessage
+        content = f"Message {i}: " + "Les dommages causés par l'eau sont couverts. " * 5
+        messages.append({"message": message_to_dict(message_class(content=content))})
+    return messages
+
+
+class _InMemoryCursor:
+    """Cursor returning the given records, to time the deserialization of the
+    history without the database round trip."""
+
+    def __init__(self, records: List[dict]):
+        self.records = records
+
+    def execute(self, query, params=None):
+        pass
+
+    def fetchall(self) -> List[dict]:
+        return self.records
+
+
+def package_benchmarks() -> Dict[str, Callable]:
+    from rag.utils import format_package_data
+    from rag.config import VectorDatabaseFilter
+
+    packages = [
+        (package_id, f"Package {package_id}", 200, 50000)
+        for package_id in (1, 2, 5, 14, 18)
+    ]
+    packages_filter = VectorDatabaseFilter(mapping_package=[1, 2, 5, 14, 18])
+    return {
+        "format_package_data": lambda: format_package_data(packages),
+        "vector_database_filter": packages_filter.filters,
+    }
+
+
+def history_benchmarks() -> Dict[str, Callable]:
+    from rag.chatbot.memory import PostgresChatMessageHistory
+
+    benchmarks = {}
+    for length in HISTORY_LENGTHS:
+        records = make_history(length)
+        dicts = [record["message"] for record in records]
+        messages = messages_from_dict(dicts)
+
+        history = PostgresChatMessageHistory.__new__(PostgresChatMessageHistory)
+        history.conversation_uuid = "benchmark"
+        history.table_name = "benchmark"
+        history.write_behind = None
+        history.connection = None
+        history.cursor = _InMemoryCursor(records)
+
+        benchmarks[f"history_messages[{length}]"] = lambda h=history: h.messages
+        benchmarks[f"messages_round_trip[{length}]"] = lambda m=messages: (
+            messages_from_dict([message_to_dict(message) for message in m])
+        )
+    return benchmarks
+
+
+def prompt_benchmarks() -> Dict[str, Callable]:
+    from rag.chatbot.llm import LangChainChatbot
+
+    prompt = LangChainChatbot(config_path=None).prompt
+    variables = {
+        "question": "Mon vélo a été volé devant la gare, suis-je couvert ?",
+        "chat_history": messages_from_dict(
+            [record["message"] for record in make_history(10)]
+        ),
+        "conversation_summary": "L'utilisateur a un vélo. " * 20,
+        "deductible": "Package 1: 200,\n" * 5,
+        "sum_insured": "Package 1: 50000,\n" * 5,
+        "context": "Article 111.1 Les dommages causés par le vol. " * 60,
+        "general_condition": "Conditions générales de l'assurance. " * 200,
+    }
+    return {"prompt_format_messages": lambda: prompt.format_messages(**variables)}
+
+
+def chroma_benchmarks(db_path: str, collection_name: str) -> Dict[str, Callable]:
+    import chromadb
+
+    # Opening a persistent collection writes to it, the benchmark runs on a copy
+    copy_path = tempfile.mkdtemp(prefix="hot_path_chroma_")
+    atexit.register(shutil.rmtree, copy_path, ignore_errors=True)
+    shutil.copytree(db_path, copy_path, dirs_exist_ok=True)
+    collection = chromadb.PersistentClient(path=copy_path).get_collection(
+        collection_name
+    )
+    embedding = collection.get(limit=1, include=["embeddings"])["embeddings"][0]
+    where = {"mapping_package": {"$in": [1, 2, 5, 14, 18]}}
+    return {
+        "chroma_query": lambda: collection.query(
+            query_embeddings=[embedding], n_results=3
+        ),
+        "chroma_query_filtered": lambda: collection.query(
+            query_embeddings=[embedding], n_results=3, where=where
+        ),
+    }
+
+
+def run_benchmarks(db_path: str, collection_name: str, only: str = None) -> dict:
+    benchmarks = {
+        **package_benchmarks(),
+        **history_benchmarks(),
+        **prompt_benchmarks(),
+        **chroma_benchmarks(db_path, collection_name),
+    }
+    return {
+        name: timeit(fn)
+        for name, fn in benchmarks.items()
+        if only is None or only in name
+    }
+
+
+def compare(results: dict, baseline: dict, default_threshold: float) -> List[dict]:
+    """Compares the fastest rounds to the baseline, and returns the
+    regressions."""
+    regressions = []
+    for name, result in results.items():
+        reference = baseline.get("benchmarks", {}).get(name)
+        if reference is None:
+            continue
+        threshold = reference.get("threshold", default_threshold)
+        ratio = result["min_us"] / reference["min_us"]
+        result["baseline_min_us"] = reference["min_us"]
+        result["ratio"] = ratio
+        if ratio > 1 + threshold:
+            regressions.append({"name": name, "ratio": ratio, "threshold": threshold})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db-path", default=DB_PATH)
+    parser.add_argument("--collection-name", default=COLLECTION_NAME)
+    parser.add_argument("--only", help="Only run the benchmarks containing this")
+    parser.add_argument("--baseline", help="Compare to this baseline")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument("--save-baseline", help="Write the results as a baseline")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.db_path, args.collection_name, args.only)
+    report = {"python": sys.version.split()[0], "benchmarks": results}
+
+    regressions = []
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        regressions = compare(results, baseline, args.threshold)
+        report["regressions"] = regressions
+
+    if args.save_baseline:
+        for result in results.values():
+            result["threshold"] = args.threshold
+        Path(args.save_baseline).write_text(json.dumps(report, indent=2))
+
+    print(json.dumps(report, indent=2))
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
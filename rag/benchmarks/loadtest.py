@@ -0,0 +1,281 @@
+"""Replays recorded request traces against the chat API (`app_b2c` or
+`dummy_app_b2c`) and reports the throughput, the p50/p95/p99 latency and the
+error rate per endpoint.
+
+A trace is a JSONL file of requests (`session`, `method`, `path` and optional
+`body`). The requests of a session are replayed in order, by one user, and
+`{conversation_uuid}` is replaced by the conversation created by the last
+`POST /conversation` of the session. The sessions arrive at `--rate` per
+second (open model, Poisson arrivals), at most `--concurrency` at a time; the
+latency is measured from the scheduled arrival, so that a saturated server
+is not hidden by the load generator. Without `--rate`, `--concurrency`
+sessions are replayed back to back (closed model).
+
+The users authenticate with tokens minted against a fake JWKS (see
+`rag.fakes.jwks`), which the app must use (`COGNITO_ISSUER`,
+`COGNITO_JWKS_URI`). For `app_b2c`, the subs of `--subs-file` must exist in
+the database.
+
+Example:
+
+    python -m rag.benchmarks.loadtest --base-url http://localhost:8000 \\
+        --key-file ./fake_jwks.pem --rate 2 --duration 60 --output report.json
+"""
+
+import os
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List
+
+import httpx
+
+from rag.benchmarks import latency_percentiles
+from rag.fakes.jwks import FakeJWKS
+
+DEFAULT_TRACE_PATH = Path(__file__).parent / "data" / "chat_trace.jsonl"
+
+
+def load_sessions(file_path) -> List[List[dict]]:
+    """Loads the trace and groups its requests by session, in order."""
+    sessions: Dict[str, List[dict]] = {}
+    with open(file_path) as fo:
+        for line in fo:
+            if line.strip():
+                request = json.loads(line)
+                sessions.setdefault(request["session"], []).append(request)
+    return list(sessions.values())
+
+
+def fill(value, variables: dict):
+    """Replaces the `{variable}` placeholders of the strings of `value`."""
+    if isinstance(value, str):
+        for name, replacement in variables.items():
+            value = value.replace("{" + name + "}", replacement)
+        return value
+    if isinstance(value, dict):
+        return {key: fill(item, variables) for key, item in value.items()}
+    if isinstance(value, list):
+        return [fill(item, variables) for item in value]
+    return value
+
+
+class LoadTest:
+    def __init__(
+        self,
+        base_url: str,
+        sessions: List[List[dict]],
+        fake_jwks: FakeJWKS,
+        issuer: str,
+        audience: str,
+        subs: List[str] = None,
+        concurrency: int = 10,
+        rate: float = None,
+        duration: float = 60,
+        think_time: float = 0,
+        timeout: float = 120,
+        seed: int = 0,
+    ):
+        self.base_url = base_url
+        self.sessions = sessions
+        self.fake_jwks = fake_jwks
+        self.issuer = issuer
+        self.audience = audience
+        self.subs = subs
+        self.concurrency = concurrency
+        self.rate = rate
+        self.duration = duration
+        self.think_time = think_time
+        self.timeout = timeout
+        self.rng = random.Random(seed)
+
+        # endpoint -> [(latency, status)]
+        self.results = defaultdict(list)
+        self.sessions_started = 0
+        self.sessions_dropped = 0
+        self._tokens = {}
+
+    def token(self, sub: str) -> str:
+        if sub not in self._tokens:
+            self._tokens[sub] = self.fake_jwks.mint_token(
+                issuer=self.issuer,
+                audience=self.audience,
+                sub=sub,
+                email=f"{sub}@loadtest.local",
+                ttl=int(self.duration) + 3600,
+            )
+        return self._tokens[sub]
+
+    def next_sub(self) -> str:
+        if self.subs:
+            return self.subs[self.sessions_started % len(self.subs)]
+        return str(uuid.uuid4())
+
+    async def replay_session(
+        self, client: httpx.AsyncClient, session: List[dict], scheduled: float
+    ):
+        sub = self.next_sub()
+        self.sessions_started += 1
+        headers = {"Authorization": f"Bearer {self.token(sub)}"}
+        variables = {}
+
+        for i, request in enumerate(session):
+            if i and self.think_time:
+                await asyncio.sleep(self.rng.expovariate(1 / self.think_time))
+                scheduled = time.perf_counter()
+            endpoint = f"{request['method']} {request['path']}"
+            try:
+                response = await client.request(
+                    request["method"],
+                    fill(request["path"], variables),
+                    json=fill(request.get("body"), variables),
+                    headers=headers,
+                )
+                status_code = response.status_code
+            except httpx.HTTPError as error:
+                response, status_code = None, type(error).__name__
+            # The first request of the session is late if it waited for a slot
+            self.results[endpoint].append(
+                (time.perf_counter() - scheduled, status_code)
+            )
+            scheduled = time.perf_counter()
+
+            if response is None or response.status_code >= 400:
+                # The next requests would depend on this one
+                break
+            if request["method"] == "POST" and request["path"] == "/conversation":
+                variables["conversation_uuid"] = response.json()["conversation_uuid"]
+
+    async def run(self) -> dict:
+        limits = httpx.Limits(
+            max_connections=self.concurrency, max_keepalive_connections=self.concurrency
+        )
+        async with httpx.AsyncClient(
+            base_url=self.base_url, limits=limits, timeout=self.timeout
+        ) as client:
+            start = time.perf_counter()
+            if self.rate:
+                await self._run_open(client, start)
+            else:
+                await self._run_closed(client, start)
+            elapsed = time.perf_counter() - start
+        return self.report(elapsed)
+
+    async def _run_open(self, client: httpx.AsyncClient, start: float):
+        slots = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+
+        async def arrival(session, scheduled):
+            async with slots:
+                await self.replay_session(client, session, scheduled)
+
+        next_arrival = start
+        while next_arrival - start < self.duration:
+            await asyncio.sleep(max(next_arrival - time.perf_counter(), 0))
+            if slots.locked():
+                # Beyond the concurrency cap, the arrival is dropped
+                self.sessions_dropped += 1
+            else:
+                task = asyncio.create_task(
+                    arrival(self.rng.choice(self.sessions), next_arrival)
+                )
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            next_arrival += self.rng.expovariate(self.rate)
+        await asyncio.gather(*tasks)
+
+    async def _run_closed(self, client: httpx.AsyncClient, start: float):
+        async def worker():
+            while time.perf_counter() - start < self.duration:
+                await self.replay_session(
+                    client, self.rng.choice(self.sessions), time.perf_counter()
+                )
+
+        await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+
+    @staticmethod
+    def summarize(results: List[tuple], elapsed: float) -> dict:
+        errors = defaultdict(int)
+        for _, status_code in results:
+            if not isinstance(status_code, int) or status_code >= 400:
+                errors[str(status_code)] += 1
+        return {
+            "requests": len(results),
+            "throughput_rps": len(results) / elapsed,
+            "error_rate": sum(errors.values()) / len(results),
+            "errors": dict(errors),
+            **latency_percentiles([latency for latency, _ in results]),
+        }
+
+    def report(self, elapsed: float) -> dict:
+        all_results = [
+            result for results in self.results.values() for result in results
+        ]
+        return {
+            "base_url": self.base_url,
+            "model": "open" if self.rate else "closed",
+            "rate": self.rate,
+            "concurrency": self.concurrency,
+            "duration_s": elapsed,
+            "sessions": self.sessions_started,
+            "sessions_dropped": self.sessions_dropped,
+            "total": self.summarize(all_results, elapsed) if all_results else {},
+            "endpoints": {
+                endpoint: self.summarize(results, elapsed)
+                for endpoint, results in sorted(self.results.items())
+            },
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--trace", default=DEFAULT_TRACE_PATH)
+    parser.add_argument("--key-file", default="./fake_jwks.pem")
+    parser.add_argument("--issuer", default=os.getenv("COGNITO_ISSUER"))
+    parser.add_argument("--audience", default=os.getenv("CLIENT_ID"))
+    parser.add_argument(
+        "--subs-file", help="Subs of the users, one per line (random if unset)"
+    )
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--rate", type=float, help="Sessions per second (open model)")
+    parser.add_argument("--duration", type=float, default=60)
+    parser.add_argument(
+        "--think-time", type=float, default=0, help="Mean seconds between requests"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    subs = None
+    if args.subs_file:
+        subs = [line.strip() for line in open(args.subs_file) if line.strip()]
+
+    load_test = LoadTest(
+        base_url=args.base_url,
+        sessions=load_sessions(args.trace),
+        fake_jwks=FakeJWKS(args.key_file),
+        issuer=args.issuer,
+        audience=args.audience,
+        subs=subs,
+        concurrency=args.concurrency,
+        rate=args.rate,
+        duration=args.duration,
+        think_time=args.think_time,
+        seed=args.seed,
+    )
+    report = asyncio.run(load_test.run())
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""Offline benchmark of the retrieval of `VectorZurichChromaDbClient`.
+
+Runs a labelled question set (question, packages of the user and expected
+document ids) against a collection and reports recall@k, MRR and the
+p50/p95/p99 retrieval latency for every backend and configuration.
+
+Example:
+
+    python -m rag.benchmarks.retrieval --db-path ./db_test --top-k 3 5 --rerank
+"""
+
+import argparse
+import json
+import time
+from pathlib import Path
+from typing import List
+
+import numpy as np
+
+from rag.benchmarks import latency_percentiles
+from rag.config import VectorDatabaseFilter
+from rag.constants import DB_PATH, COLLECTION_NAME
+
+DEFAULT_QUESTIONS_PATH = Path(__file__).parent / "data" / "retrieval_questions.jsonl"
+
+
+def load_questions(file_path) -> List[dict]:
+    """Loads the labelled questions from a JSONL file. Every line contains the
+    `question`, the `packages` of the user and the `expected_ids`."""
+    with open(file_path) as fo:
+        return [json.loads(line) for line in fo if line.strip()]
+
+
+def evaluate(client, questions: List[dict], top_k: int, repeat: int = 1) -> dict:
+    """
+    Runs the questions against a retrieval client.
+
+    Args:
+        client: a `VectorZurichChromaDbClient` (or any object with the same
+        `get_zurich_package_chunks` method).
+        questions (List[dict]): the labelled questions.
+        top_k (int): number of retrieved documents.
+        repeat (int): number of timed runs of every question.
+
+    Returns:
+        dict: recall@k, MRR and the latency percentiles.
+    """
+    recalls, reciprocal_ranks, latencies = [], [], []
+
+    for item in questions:
+        user_filter = VectorDatabaseFilter(mapping_package=item["packages"]).filters()
+        expected = set(item["expected_ids"])
+
+        for _ in range(repeat):
+            start = time.perf_counter()
+            chunks = client.get_zurich_package_chunks(
+                filter_packages=user_filter,
+                top_k=top_k,
+                user_question=item["question"],
+            )
+            latencies.append(time.perf_counter() - start)
+
+        ids = chunks["ids"]
+        recalls.append(len(expected.intersection(ids)) / len(expected))
+        ranks = [rank for rank, doc_id in enumerate(ids, 1) if doc_id in expected]
+        reciprocal_ranks.append(1 / ranks[0] if ranks else 0.0)
+
+    return {
+        "questions": len(questions),
+        f"recall@{top_k}": float(np.mean(recalls)),
+        "mrr": float(np.mean(reciprocal_ranks)),
+        **latency_percentiles(latencies),
+    }
+
+
+def get_local_client(db_path: str, collection_name: str, rerank: bool):
+    from rag.utils import sentence_transformer_ef
+    from rag.chatbot.retriever import VectorZurichChromaDbClient
+    from rag.chatbot.reranker import CrossEncoderReranker
+
+    return VectorZurichChromaDbClient.get_retriever(
+        db_path=db_path,
+        collection_name=collection_name,
+        embeddings=sentence_transformer_ef,
+        reranker=CrossEncoderReranker() if rerank else None,
+    )
+
+
+def run_benchmark(
+    db_path: str,
+    collection_name: str,
+    questions_path,
+    top_ks: List[int],
+    rerank: bool = False,
+    repeat: int = 3,
+) -> dict:
+    """Runs every configuration and returns the report."""
+    questions = load_questions(questions_path)
+
+    configurations = [{"backend": "local", "rerank": False}]
+    if rerank:
+        configurations.append({"backend": "local", "rerank": True})
+
+    results = []
+    for configuration in configurations:
+        client = get_local_client(db_path, collection_name, configuration["rerank"])
+        # Warm-up: loads the model weights and the index in memory
+        evaluate(client, questions[:1], top_k=max(top_ks))
+
+        for top_k in top_ks:
+            results.append(
+                {
+                    **configuration,
+                    "top_k": top_k,
+                    **evaluate(client, questions, top_k=top_k, repeat=repeat),
+                }
+            )
+
+    return {
+        "db_path": db_path,
+        "collection_name": collection_name,
+        "questions_path": str(questions_path),
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db-path", default=DB_PATH)
+    parser.add_argument("--collection-name", default=COLLECTION_NAME)
+    parser.add_argument("--questions", default=DEFAULT_QUESTIONS_PATH)
+    parser.add_argument("--top-k", type=int, nargs="+", default=[1, 3, 5])
+    parser.add_argument(
+        "--rerank", action="store_true", help="Also run with the cross-encoder"
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(
+        db_path=args.db_path,
+        collection_name=args.collection_name,
+        questions_path=args.questions,
+        top_ks=args.top_k,
+        rerank=args.rerank,
+        repeat=args.repeat,
+    )
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+import logging
+from typing import List, Tuple
+
+import numpy as np
+import tiktoken
+
+from rag.constants import (
+    CONTEXT_MMR_LAMBDA,
+    CONTEXT_DUPLICATE_THRESHOLD,
+    CONTEXT_MAX_GENERAL_CHUNKS,
+    CONTEXT_STATIC_GENERAL_CONDITION,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """Returns the tiktoken encoding of the model, `cl100k_base` if unknown."""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def _normalize(embeddings) -> np.ndarray:
+    matrix = np.asarray(embeddings, dtype=np.float32).reshape(len(embeddings), -1)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+class ContextAssembler:
+    """
+    Assembles the context of the LLM from the retrieved package chunks and the
+    general condition chunks, using the embeddings stored in the collection.
+
+    Near-duplicate chunks (cosine similarity above `duplicate_threshold`) are
+    dropped. By default the general condition is kept whole, so that it is
+    identical for every request and can be cached by the provider, and the
+    package chunks it already contains are dropped. Otherwise the package
+    chunks have priority, and the general condition chunks are selected with
+    maximal marginal relevance (MMR), so that only the chunks relevant to the
+    question and not redundant with the rest of the context are kept.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        lambda_mult: float = CONTEXT_MMR_LAMBDA,
+        duplicate_threshold: float = CONTEXT_DUPLICATE_THRESHOLD,
+        max_general_chunks: int = CONTEXT_MAX_GENERAL_CHUNKS,
+        static_general_condition: bool = CONTEXT_STATIC_GENERAL_CONDITION,
+    ):
+        """
+        :param model: The LLM model, used to count the tokens of the context.
+        :param lambda_mult: MMR trade-off between relevance (1) and diversity (0).
+        :param duplicate_threshold: Cosine similarity above which two chunks
+            are considered duplicates.
+        :param max_general_chunks: Maximum number of general condition chunks.
+        :param static_general_condition: Keep the whole general condition, the
+            same for every request so that it can be cached by the provider,
+            instead of selecting its chunks with MMR.
+        """
+        self.encoding = get_encoding(model)
+        self.lambda_mult = lambda_mult
+        self.duplicate_threshold = duplicate_threshold
+        self.max_general_chunks = max_general_chunks
+        self.static_general_condition = static_general_condition
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.encoding.encode(text))
+
+    @staticmethod
+    def format_context(package_documents: List[str], general_documents: List[str]):
+        package_info = "\n".join(package_documents)
+        general_condition = "\n".join(general_documents)
+        return f"{package_info}\nThe insurance general condition:{general_condition}"
+
+    def _deduplicate(
+        self, vectors: np.ndarray, candidates: List[int], kept: List[int]
+    ) -> List[int]:
+        """Returns the candidates that are not near-duplicates of a kept chunk
+        or of a previous candidate, and adds them to `kept`."""
+        unique = []
+        for i in candidates:
+            if kept and np.max(vectors[kept] @ vectors[i]) > self.duplicate_threshold:
+                continue
+            kept.append(i)
+            unique.append(i)
+        return unique
+
+    def _mmr(
+        self, query: np.ndarray, vectors: np.ndarray, candidates: List[int], selected
+    ) -> List[int]:
+        """Selects up to `max_general_chunks` candidates with MMR, taking into
+        account the already `selected` chunks for the redundancy term."""
+        selected = list(selected)
+        chosen = []
+        relevance = vectors @ query
+        while candidates and len(chosen) < self.max_general_chunks:
+            if selected:
+                redundancy = np.max(vectors[candidates] @ vectors[selected].T, axis=1)
+            else:
+                redundancy = np.zeros(len(candidates))
+            scores = (
+                self.lambda_mult * relevance[candidates]
+                - (1 - self.lambda_mult) * redundancy
+            )
+            best = candidates.pop(int(np.argmax(scores)))
+            selected.append(best)
+            chosen.append(best)
+        return chosen
+
+    def assemble(
+        self,
+        query_embedding: List[float],
+        package_chunks: dict,
+        general_chunks: dict,
+    ) -> Tuple[str, str, dict]:
+        """
+        Builds the context from the chunks returned by
+        `VectorZurichChromaDbClient`.
+
+        :param query_embedding: Embedding of the user question.
+        :param package_chunks: `ids`, `documents` and `embeddings` of the
+            retrieved package chunks, most relevant first.
+        :param general_chunks: `ids`, `documents` and `embeddings` of the
+            general condition chunks.
+        :return: The package context, the general condition and a dictionary
+            with the kept chunk ids, the number of tokens of the context and
+            the number of tokens saved compared to the concatenation of all
+            the chunks.
+        """
+        package_documents = package_chunks["documents"]
+        general_documents = general_chunks["documents"]
+        n_package = len(package_documents)
+        package_range = list(range(n_package))
+        general_range = list(range(n_package, n_package + len(general_documents)))
+
+        naive_context = self.format_context(package_documents, general_documents)
+
+        vectors = _normalize(
+            list(package_chunks["embeddings"]) + list(general_chunks["embeddings"])
+        )
+        query = _normalize([query_embedding])[0]
+
+        kept = []
+        if self.static_general_condition:
+            # The whole general condition is kept, identical for every request,
+            # and the package chunks it already contains are dropped.
+            general_kept = general_range
+            kept.extend(general_kept)
+            package_kept = self._deduplicate(vectors, package_range, kept)
+        else:
+            # Package chunks first so that they win over the general condition
+            package_kept = self._deduplicate(vectors, package_range, kept)
+            general_candidates = self._deduplicate(vectors, general_range, kept)
+            general_kept = sorted(
+                self._mmr(query, vectors, general_candidates, selected=package_kept)
+            )
+
+        ids = list(package_chunks["ids"]) + list(general_chunks["ids"])
+        context_documents = [package_documents[i] for i in package_kept]
+        general_condition_documents = [
+            general_documents[i - n_package] for i in general_kept
+        ]
+        context_tokens = self.count_tokens(
+            self.format_context(context_documents, general_condition_documents)
+        )
+        stats = {
+            "ids": [ids[i] for i in package_kept + general_kept],
+            "context_tokens": context_tokens,
+            "context_tokens_saved": self.count_tokens(naive_context) - context_tokens,
+        }
+        logger.info(
+            "Context assembled with %d chunks, %d tokens saved",
+            len(stats["ids"]),
+            stats["context_tokens_saved"],
+        )
+        return (
+            "\n".join(context_documents),
+            "\n".join(general_condition_documents),
+            stats,
+        )
@@ -0,0 +1,121 @@
+import logging
+import importlib.util
+
+import httpx
+from prometheus_client import Counter, Gauge
+
+from rag.config import HTTPClientConfig
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 40.0  # seconds, as the `timeout` of the LLM configs
+
+LLM_HTTP_REQUESTS = Counter(
+    "llm_http_requests_total",
+    "Number of HTTP requests sent to the LLM providers",
+    ["client", "host", "status"],
+)
+LLM_HTTP_CONNECTIONS = Gauge(
+    "llm_http_connections",
+    "Number of pooled connections to the LLM providers",
+    ["client", "state"],
+    multiprocess_mode="livesum",
+)
+
+
+def _pool_connections(client, idle: bool) -> int:
+    # httpx does not expose its connection pool
+    pool = getattr(getattr(client, "_transport", None), "_pool", None)
+    connections = getattr(pool, "connections", [])
+    return sum(1 for connection in connections if connection.is_idle() == idle)
+
+
+class SharedHTTPClient:
+    """
+    Pooled keep-alive `httpx` clients, sync and async, shared by all the LLM
+    clients of the process so that the connections (and their TLS sessions)
+    are reused across chains, hedged requests and retries.
+
+    The connect and pool timeouts are split from the overall `timeout` of the
+    LLM configs, which bounds the read and the write unless a read timeout is
+    set (see `get_timeout`). HTTP/2 is used when the `h2` package is
+    installed.
+    """
+
+    def __init__(self, config: HTTPClientConfig):
+        """
+        :param config: The pool limits and timeouts.
+        """
+        self.config = config
+        self.http2 = config.http2 and importlib.util.find_spec("h2") is not None
+        self.limits = httpx.Limits(
+            max_connections=config.max_connections,
+            max_keepalive_connections=config.max_keepalive_connections,
+            keepalive_expiry=config.keepalive_expiry,
+        )
+        # Overridden by the LLM clients with their own `timeout`
+        self.timeout = self.get_timeout(DEFAULT_TIMEOUT)
+        self.sync_client = httpx.Client(
+            limits=self.limits,
+            timeout=self.timeout,
+            http2=self.http2,
+            event_hooks={"response": [self._on_response("sync")]},
+        )
+        self.async_client = httpx.AsyncClient(
+            limits=self.limits,
+            timeout=self.timeout,
+            http2=self.http2,
+            event_hooks={"response": [self._on_response_async("async")]},
+        )
+        logger.info(
+            "LLM HTTP client: %d connections, %d keep-alive, HTTP/2 %s",
+            config.max_connections,
+            config.max_keepalive_connections,
+            "on" if self.http2 else "off",
+        )
+
+    def get_timeout(self, timeout: float) -> httpx.Timeout:
+        """The timeouts of an LLM client with the given overall `timeout`."""
+        return httpx.Timeout(
+            timeout,
+            connect=self.config.connect_timeout,
+            read=self.config.read_timeout or timeout,
+            pool=self.config.pool_timeout,
+        )
+
+    def _on_response(self, name: str):
+        def hook(response: httpx.Response):
+            LLM_HTTP_REQUESTS.labels(
+                client=name, host=response.request.url.host, status=response.status_code
+            ).inc()
+            # Set on every response rather than read on scrape, so that the
+            # gauge is also exported by the workers of `rag.serve`
+            for state, count in self.stats()[name].items():
+                LLM_HTTP_CONNECTIONS.labels(client=name, state=state).set(count)
+
+        return hook
+
+    def _on_response_async(self, name: str):
+        hook = self._on_response(name)
+
+        async def async_hook(response: httpx.Response):
+            hook(response)
+
+        return async_hook
+
+    def stats(self) -> dict:
+        """Number of idle and active pooled connections of every client."""
+        return {
+            name: {
+                "idle": _pool_connections(client, True),
+                "active": _pool_connections(client, False),
+            }
+            for name, client in (
+                ("sync", self.sync_client),
+                ("async", self.async_client),
+            )
+        }
+
+    async def aclose(self) -> None:
+        self.sync_client.close()
+        await self.async_client.aclose()
@@ -1,8 +1,13 @@
 # https://gist.github.com/jvelezmagic/03ddf4c452d011aae36b2a0f73d72f68
 
-from typing import Any, Union
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple, Union
+import time
 import random
+import asyncio
+import logging
+import openai
 import tiktoken
+from collections import OrderedDict, deque
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -11,13 +16,40 @@ from langchain_openai import AzureChatOpenAI, ChatOpenAI
 from langchain.prompts import (
     ChatPromptTemplate,
     HumanMessagePromptTemplate,
+    MessagesPlaceholder,
     SystemMessagePromptTemplate,
 )
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForLLMRun,
+    BaseCallbackHandler,
+    CallbackManagerForLLMRun,
+)
+from langchain_community.callbacks.openai_info import get_openai_token_cost_for_model
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessageChunk, BaseMessage, BaseMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatResult, LLMResult
+from langchain_core.pydantic_v1 import PrivateAttr
+from langchain_core.runnables import Runnable, RunnableConfig
+from prometheus_client import Counter, Gauge, Histogram
 
-from rag.config import AzureChatOpenAIConfig, BaseOpenAIConfig
+from rag.config import (
+    AzureChatOpenAIConfig,
+    BaseOpenAIConfig,
+    HTTPClientConfig,
+    LLMGatewayConfig,
+)
+from rag.chatbot.http_client import SharedHTTPClient
+from rag.tracing import record_error, tracer
+from rag.chatbot.context import get_encoding
+from rag.chatbot.prompt import count_message_tokens
 from rag.chatbot.templates import (
     SYSTEM_MESSAGE,
+    GENERAL_CONDITION_MESSAGE,
+    USER_DATA_MESSAGE,
+    CONVERSATION_SUMMARY_MESSAGE,
     HUMAN_MESSAGE,
+    SUMMARY_SYSTEM_MESSAGE,
+    SUMMARY_HUMAN_MESSAGE,
 )
 
 from rag.chatbot.dummy_answer import (
@@ -36,6 +68,32 @@ from rag.chatbot.dummy_answer import (
     ANSWER_14,
 )
 
+logger = logging.getLogger(__name__)
+
+LLM_GATEWAY_QUEUE_DEPTH = Gauge(
+    "llm_gateway_queue_depth",
+    "Number of LLM calls waiting for a slot",
+    multiprocess_mode="livesum",
+)
+LLM_GATEWAY_IN_FLIGHT = Gauge(
+    "llm_gateway_in_flight",
+    "Number of LLM calls running",
+    multiprocess_mode="livesum",
+)
+LLM_GATEWAY_WAIT_SECONDS = Histogram(
+    "llm_gateway_wait_seconds",
+    "Time spent by the LLM calls waiting for a slot",
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+LLM_GATEWAY_REJECTED = Counter(
+    "llm_gateway_rejected_total", "Number of rejected LLM calls", ["reason"]
+)
+LLM_BACKEND_REQUESTS = Counter(
+    "llm_backend_requests_total",
+    "Number of requests sent to each LLM backend, by outcome",
+    ["backend", "outcome"],
+)
+
 
 class LangChainChatbot:
     """
@@ -43,6 +101,9 @@ class LangChainChatbot:
     using different API providers like AzureChatOpenAI and ChatOpenAI.
     """
 
+    # Pooled HTTP client shared by the language models of all the chains
+    _http_client: SharedHTTPClient = None
+
     def __init__(self, config_path: Union[Path, str]):
         """
         Initializes the chatbot with the given configuration file.
@@ -92,8 +153,53 @@ class LangChainChatbot:
         else:
             raise ValueError(f"Unsupported API type: {api_type}")
 
+        self._use_shared_http_client(api_type, config)
         return self.llm
 
+    @classmethod
+    def get_http_client(cls) -> SharedHTTPClient:
+        """Returns the pooled HTTP client shared by all the chains of the
+        process, created on first use."""
+        if cls._http_client is None:
+            cls._http_client = SharedHTTPClient(HTTPClientConfig.load_from_env())
+        return cls._http_client
+
+    @classmethod
+    async def close_http_client(cls) -> None:
+        if cls._http_client is not None:
+            await cls._http_client.aclose()
+            cls._http_client = None
+
+    def _use_shared_http_client(self, api_type: str, config: dict):
+        """
+        Replaces the OpenAI clients of the language model by clients on top of
+        the shared HTTP client (the language model passes its `http_client` to
+        both the sync and the async client, and Azure always creates its own).
+        """
+        http_client = self.get_http_client()
+        client_params = {
+            "api_key": config["api_key"],
+            "max_retries": config["max_retries"],
+            "timeout": http_client.get_timeout(config["timeout"]),
+        }
+        if api_type == "azure":
+            client_params.update(
+                azure_endpoint=config["azure_endpoint"],
+                api_version=config["api_version"],
+                azure_deployment=config["azure_deployment"],
+            )
+            sync_class, async_class = openai.AzureOpenAI, openai.AsyncAzureOpenAI
+        else:
+            client_params.update(base_url=config.get("base_url"))
+            sync_class, async_class = openai.OpenAI, openai.AsyncOpenAI
+
+        self.llm.client = sync_class(
+            **client_params, http_client=http_client.sync_client
+        ).chat.completions
+        self.llm.async_client = async_class(
+            **client_params, http_client=http_client.async_client
+        ).chat.completions
+
     @property
     def prompt(self):
         if self._prompt is None:
@@ -109,10 +215,14 @@ class LangChainChatbot:
         """
         Creates and returns the chat prompt template.
         """
-        # Placeholder for actual message template classes
+        # Static parts first so that the prefix can be cached by the provider
         return ChatPromptTemplate(
             messages=[
                 SystemMessagePromptTemplate.from_template(SYSTEM_MESSAGE),
+                SystemMessagePromptTemplate.from_template(GENERAL_CONDITION_MESSAGE),
+                SystemMessagePromptTemplate.from_template(USER_DATA_MESSAGE),
+                SystemMessagePromptTemplate.from_template(CONVERSATION_SUMMARY_MESSAGE),
+                MessagesPlaceholder(variable_name="chat_history"),
                 HumanMessagePromptTemplate.from_template(HUMAN_MESSAGE),
             ]
         )
@@ -127,6 +237,604 @@ class LangChainChatbot:
         # Assuming | operator combines prompt and llm into a retrieval chain
         return chatbot_instance.prompt | chatbot_instance.llm
 
+    @classmethod
+    def summarizer_from_config(cls, api_type: str, config_path: Union[Path, str]):
+        """
+        Class method to create the chain that folds new messages into the rolling
+        summary of a conversation.
+        """
+        chatbot_instance = cls(config_path)
+        chatbot_instance._get_llm(api_type)
+        summary_prompt = ChatPromptTemplate(
+            messages=[
+                SystemMessagePromptTemplate.from_template(SUMMARY_SYSTEM_MESSAGE),
+                HumanMessagePromptTemplate.from_template(SUMMARY_HUMAN_MESSAGE),
+            ]
+        )
+        return summary_prompt | chatbot_instance.llm
+
+    @classmethod
+    def hedged_from_config(
+        cls, backends: List[Tuple[str, Union[Path, str]]], **kwargs: Any
+    ):
+        """
+        Class method to create the retrieval chain on top of several backends,
+        hedged and with failover (see `HedgedChatModel`).
+
+        :param backends: The (api_type, config_path) of every backend, by
+            order of preference.
+        """
+        chatbot_instances = [cls(config_path) for _, config_path in backends]
+        llms = [
+            chatbot_instance._get_llm(api_type)
+            for chatbot_instance, (api_type, _) in zip(chatbot_instances, backends)
+        ]
+        chatbot_instances[0].llm = HedgedChatModel(backends=llms, **kwargs)
+        return chatbot_instances[0].prompt | chatbot_instances[0].llm
+
+
+class BackendHealth:
+    """Health of an LLM backend: moving average of its success rate and rolling
+    window of its time to first token."""
+
+    def __init__(self, window: int = 200):
+        self.success_rate = 1.0
+        self.ttfts = deque(maxlen=window)
+
+    def record_success(self, ttft: float):
+        self.success_rate = 0.9 * self.success_rate + 0.1
+        self.ttfts.append(ttft)
+
+    def record_failure(self):
+        self.success_rate = 0.9 * self.success_rate
+
+    def ttft_percentile(self, q: float) -> Optional[float]:
+        if not self.ttfts:
+            return None
+        ordered = sorted(self.ttfts)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+    @property
+    def score(self) -> float:
+        """Higher is better: the success rate, then the median time to first
+        token break the ties."""
+        return self.success_rate - 0.01 * (self.ttft_percentile(0.5) or 0)
+
+
+class HedgedChatModel(BaseChatModel):
+    """
+    Chat model on top of several backends (e.g. `AzureChatOpenAI` and
+    `ChatOpenAI`), ordered by health score.
+
+    The request is streamed from the healthiest backend. If no token was
+    received after the p95 time to first token of that backend, the request is
+    hedged: it is also sent to the next backend. The first backend to produce a
+    token wins and the others are cancelled. On error, the request fails over
+    to the next backend.
+
+    The backends are streamed with the usage reported at the end of the
+    stream (`stream_options`), including the prompt tokens served from the
+    provider cache. For the backends that do not report it, the usage is
+    counted with tiktoken for the callbacks (`get_openai_callback`). The
+    synchronous calls are not streamed, their backend reports the usage.
+    """
+
+    backends: List[BaseChatModel]
+    # Hedge delay until enough times to first token are recorded
+    initial_hedge_delay: float = 2.0
+    min_hedge_delay: float = 0.2
+    min_samples: int = 20
+    # Usage at the end of the streams, not supported by the Azure API
+    # versions before 2024-09-01-preview
+    stream_usage: bool = True
+    _health: List[BackendHealth] = PrivateAttr()
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def __init__(self, **kwargs: Any):
+        super().__init__(**kwargs)
+        self._health = [BackendHealth() for _ in self.backends]
+
+    @property
+    def _llm_type(self) -> str:
+        return "hedged-chat"
+
+    @property
+    def model_name(self) -> str:
+        return self.backends[0].model_name
+
+    @property
+    def health(self) -> List[Dict[str, Any]]:
+        """Health of every backend, e.g. for metrics."""
+        return [
+            {
+                "backend": self._backend_name(index),
+                "success_rate": health.success_rate,
+                "ttft_p50": health.ttft_percentile(0.5),
+                "ttft_p95": health.ttft_percentile(0.95),
+            }
+            for index, health in enumerate(self._health)
+        ]
+
+    def _backend_name(self, index: int) -> str:
+        return f"{index}:{self.backends[index]._llm_type}"
+
+    def _ordered_backends(self) -> List[int]:
+        return sorted(
+            range(len(self.backends)), key=lambda i: self._health[i].score, reverse=True
+        )
+
+    def _hedge_delay(self, index: int) -> float:
+        health = self._health[index]
+        if len(health.ttfts) < self.min_samples:
+            return self.initial_hedge_delay
+        return max(health.ttft_percentile(0.95), self.min_hedge_delay)
+
+    def _record(self, index: int, outcome: str, ttft: float = None):
+        LLM_BACKEND_REQUESTS.labels(
+            backend=self._backend_name(index), outcome=outcome
+        ).inc()
+        if outcome == "success":
+            self._health[index].record_success(ttft)
+        elif outcome == "error":
+            self._health[index].record_failure()
+
+    def _create_result(
+        self,
+        index: int,
+        messages,
+        message: BaseMessage,
+        count_tokens: bool = True,
+        usage: Optional[dict] = None,
+    ):
+        model_name = getattr(self.backends[index], "model_name", "")
+        if not count_tokens:
+            return ChatResult(
+                generations=[ChatGeneration(message=message)],
+                llm_output={"model_name": model_name},
+            )
+        if usage:
+            token_usage = {
+                key: usage[key]
+                for key in ("prompt_tokens", "completion_tokens", "total_tokens")
+            }
+            if isinstance(usage.get("prompt_tokens_details"), dict):
+                token_usage["prompt_tokens_details"] = usage["prompt_tokens_details"]
+        else:
+            encoding = get_encoding(model_name)
+            prompt_tokens = count_message_tokens(encoding, messages)
+            completion_tokens = len(encoding.encode(message.content))
+            token_usage = {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            }
+        return ChatResult(
+            generations=[ChatGeneration(message=message)],
+            llm_output={"token_usage": token_usage, "model_name": model_name},
+        )
+
+    def _combine_llm_outputs(self, llm_outputs: List[Optional[dict]]) -> dict:
+        token_usage = {}
+        model_name = None
+        for output in llm_outputs:
+            if output is None:
+                continue
+            model_name = model_name or output.get("model_name")
+            for key, value in output.get("token_usage", {}).items():
+                if isinstance(value, dict):
+                    details = token_usage.setdefault(key, {})
+                    for name, count in value.items():
+                        details[name] = details.get(name, 0) + (count or 0)
+                else:
+                    token_usage[key] = token_usage.get(key, 0) + value
+        return {"token_usage": token_usage, "model_name": model_name}
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        """Synchronous calls only fail over, they are not hedged."""
+        error = None
+        for index in self._ordered_backends():
+            start = time.perf_counter()
+            try:
+                message = self.backends[index].invoke(messages, stop=stop, **kwargs)
+            except Exception as e:
+                logger.warning("LLM backend %s failed: %s", index, e)
+                self._record(index, "error")
+                error = e
+                continue
+            self._record(index, "success", time.perf_counter() - start)
+            # The usage is already reported to the callbacks by the backend
+            return self._create_result(index, messages, message, count_tokens=False)
+        raise error
+
+    async def _astream_with_usage(
+        self, index: int, messages, stop, usage: dict, **kwargs: Any
+    ) -> AsyncIterator[BaseMessageChunk]:
+        """Streams the message chunks of a backend, and sets its token usage in
+        `usage` if the backend reports it (see `stream_usage`).
+
+        `astream` of langchain-openai drops the usage chunk at the end of the
+        stream, so the OpenAI backends are streamed with their client. The
+        other backends, and the OpenAI ones if langchain-openai changes, are
+        streamed with `astream`, without usage."""
+        backend = self.backends[index]
+        try:
+            if not self.stream_usage:
+                raise AttributeError("stream_usage")
+            from langchain_openai.chat_models.base import (
+                _convert_delta_to_message_chunk,
+            )
+
+            create_message_dicts = backend._create_message_dicts
+            client = backend.async_client
+        except (ImportError, AttributeError):
+            async for chunk in backend.astream(messages, stop=stop, **kwargs):
+                yield chunk
+            return
+
+        message_dicts, params = create_message_dicts(messages, stop)
+        params = {
+            **params,
+            **kwargs,
+            "stream": True,
+            "stream_options": {"include_usage": True},
+        }
+        chunk_class = AIMessageChunk
+        async for chunk in await client.create(messages=message_dicts, **params):
+            if not isinstance(chunk, dict):
+                chunk = chunk.model_dump()
+            if chunk.get("usage"):
+                usage.update(chunk["usage"])
+            if not chunk["choices"]:
+                continue
+            message = _convert_delta_to_message_chunk(
+                chunk["choices"][0]["delta"], chunk_class
+            )
+            chunk_class = message.__class__
+            yield message
+
+    async def _stream_backend(
+        self, index: int, messages, stop, events: asyncio.Queue, **kwargs: Any
+    ):
+        """Streams a backend and reports its first token, its result and usage
+        or its error on the `events` queue, with its task, so that the events
+        of a cancelled task are told apart from those of a relaunch."""
+        task = asyncio.current_task()
+        start = time.perf_counter()
+        message = None
+        usage = {}
+        try:
+            async for chunk in self._astream_with_usage(
+                index, messages, stop, usage, **kwargs
+            ):
+                if message is None:
+                    message = chunk
+                    await events.put(
+                        ("first", index, task, time.perf_counter() - start)
+                    )
+                else:
+                    message += chunk
+            await events.put(("done", index, task, (message, usage)))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await events.put(("error", index, task, e))
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        order = self._ordered_backends()
+        events = asyncio.Queue()
+        tasks = {}
+        winner = None
+        error = None
+        loop = asyncio.get_running_loop()
+        hedge_at = None
+
+        def next_backend() -> Optional[int]:
+            # A backend cancelled as a hedging loser may be launched again
+            for index in order:
+                if index not in failed and index not in tasks:
+                    return index
+            return None
+
+        def launch():
+            nonlocal hedge_at
+            index = next_backend()
+            tasks[index] = asyncio.create_task(
+                self._stream_backend(index, messages, stop, events, **kwargs)
+            )
+            hedge_at = loop.time() + self._hedge_delay(index)
+
+        failed = set()
+        launch()
+        try:
+            while True:
+                can_launch = next_backend() is not None
+                timeout = None
+                if winner is None and can_launch:
+                    timeout = max(hedge_at - loop.time(), 0)
+                try:
+                    kind, index, task, payload = await asyncio.wait_for(
+                        events.get(), timeout=timeout
+                    )
+                except asyncio.TimeoutError:
+                    # No token yet: hedge with the next backend
+                    launch()
+                    continue
+
+                if tasks.get(index) is not task:
+                    # Queued by a cancelled task, maybe relaunched since
+                    continue
+                if kind == "first" and winner is None:
+                    winner = index
+                    self._record(index, "success", payload)
+                    for other, task in list(tasks.items()):
+                        if other != index:
+                            task.cancel()
+                            tasks.pop(other)
+                            self._record(other, "cancelled")
+                elif kind == "done" and winner in (None, index):
+                    message, usage = payload
+                    return self._create_result(index, messages, message, usage=usage)
+                elif kind == "error":
+                    logger.warning("LLM backend %s failed: %s", index, payload)
+                    self._record(index, "error")
+                    tasks.pop(index)
+                    failed.add(index)
+                    error = payload
+                    if winner == index:
+                        winner = None
+                    if not tasks:
+                        if next_backend() is None:
+                            raise error
+                        # Fail over to the next backend
+                        launch()
+        finally:
+            for task in tasks.values():
+                task.cancel()
+
+
+class LLMOverloadedError(Exception):
+    """Raised when the LLM gateway cannot admit a call in time."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class LLMGateway:
+    """
+    Admission control in front of the LLM calls.
+
+    At most `max_concurrency` calls run at the same time. The others wait in a
+    bounded queue, served round-robin across users so that a single user
+    cannot starve the others. A call is rejected with `LLMOverloadedError` if
+    the queue is full, if its estimated wait exceeds `max_wait`, or if it
+    waited `max_wait` without getting a slot.
+    """
+
+    def __init__(self, max_concurrency: int, max_queue_size: int, max_wait: float):
+        self.max_concurrency = max_concurrency
+        self.max_queue_size = max_queue_size
+        self.max_wait = max_wait
+        self._in_flight = 0
+        self._waiters = OrderedDict()  # user id -> deque of futures
+        self._queue_depth = 0
+        self._avg_service_time = None
+
+    @classmethod
+    def from_config(cls, config: LLMGatewayConfig) -> "LLMGateway":
+        return cls(**config.model_dump())
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue_depth
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def estimated_wait(self, position: int) -> float:
+        """Estimated wait of a call at the given position in the queue."""
+        if self._avg_service_time is None:
+            return 0.0
+        return position / self.max_concurrency * self._avg_service_time
+
+    def _reject(self, reason: str, retry_after: float):
+        LLM_GATEWAY_REJECTED.labels(reason=reason).inc()
+        raise LLMOverloadedError(
+            f"LLM gateway overloaded ({reason})", retry_after=max(retry_after, 1.0)
+        )
+
+    def _update_metrics(self):
+        LLM_GATEWAY_QUEUE_DEPTH.set(self._queue_depth)
+        LLM_GATEWAY_IN_FLIGHT.set(self._in_flight)
+
+    def _remove_waiter(self, user_id: str, waiter: asyncio.Future):
+        user_waiters = self._waiters.get(user_id)
+        if user_waiters is not None and waiter in user_waiters:
+            user_waiters.remove(waiter)
+            self._queue_depth -= 1
+            if not user_waiters:
+                del self._waiters[user_id]
+
+    async def acquire(self, user_id: str) -> None:
+        """Waits for a slot, or raises `LLMOverloadedError`."""
+        if self._in_flight < self.max_concurrency and not self._waiters:
+            self._in_flight += 1
+            self._update_metrics()
+            return
+
+        if self._queue_depth >= self.max_queue_size:
+            self._reject("queue_full", self.estimated_wait(self._queue_depth + 1))
+
+        estimated_wait = self.estimated_wait(self._queue_depth + 1)
+        if estimated_wait > self.max_wait:
+            self._reject("deadline", estimated_wait)
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(user_id, deque()).append(waiter)
+        self._queue_depth += 1
+        self._update_metrics()
+
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout=self.max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as error:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over right at the deadline
+                if isinstance(error, asyncio.CancelledError):
+                    self.release()
+                    raise
+            else:
+                waiter.cancel()
+                self._remove_waiter(user_id, waiter)
+                self._update_metrics()
+                if isinstance(error, asyncio.CancelledError):
+                    raise
+                self._reject("timeout", self.estimated_wait(self._queue_depth))
+        finally:
+            LLM_GATEWAY_WAIT_SECONDS.observe(time.perf_counter() - start)
+
+    def release(self) -> None:
+        """Hands the slot over to the next waiter, round-robin across users."""
+        while self._waiters:
+            user_id, user_waiters = next(iter(self._waiters.items()))
+            waiter = user_waiters.popleft()
+            self._queue_depth -= 1
+            if user_waiters:
+                self._waiters.move_to_end(user_id)
+            else:
+                del self._waiters[user_id]
+            if not waiter.done():
+                waiter.set_result(None)
+                self._update_metrics()
+                return
+
+        self._in_flight -= 1
+        self._update_metrics()
+
+    def _update_service_time(self, elapsed: float):
+        if self._avg_service_time is None:
+            self._avg_service_time = elapsed
+        else:
+            self._avg_service_time = 0.9 * self._avg_service_time + 0.1 * elapsed
+
+    async def ainvoke(
+        self,
+        runnable: Runnable,
+        input: Any,
+        user_id: str,
+        config: RunnableConfig = None,
+    ) -> Any:
+        """Invokes the runnable once admitted."""
+        await self.acquire(user_id)
+        start = time.perf_counter()
+        try:
+            return await runnable.ainvoke(input, config=config)
+        finally:
+            self._update_service_time(time.perf_counter() - start)
+            self.release()
+
+
+class CachedTokensCallbackHandler(BaseCallbackHandler):
+    """Callback handler that collects the prompt tokens served from the
+    provider prompt cache, as reported in the token usage of the response."""
+
+    def __init__(self):
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        token_usage = (response.llm_output or {}).get("token_usage") or {}
+        prompt_tokens_details = token_usage.get("prompt_tokens_details") or {}
+        self.prompt_tokens += token_usage.get("prompt_tokens", 0)
+        self.cached_tokens += prompt_tokens_details.get("cached_tokens") or 0
+
+    @property
+    def cached_ratio(self) -> float:
+        if not self.prompt_tokens:
+            return 0.0
+        return self.cached_tokens / self.prompt_tokens
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """Callback handler tracing every LLM call in a span, with the token usage
+    and the cost reported in the response."""
+
+    # Called in the context of the chain, so that the spans have its parent
+    run_inline = True
+
+    def __init__(self):
+        self._spans = {}
+
+    def _start_span(self, run_id, **kwargs: Any) -> None:
+        params = kwargs.get("invocation_params") or {}
+        model = params.get("model_name") or params.get("model") or "unknown"
+        self._spans[run_id] = tracer.start_span(
+            f"llm {model}",
+            attributes={
+                "gen_ai.system": params.get("_type", "unknown"),
+                "gen_ai.request.model": model,
+                "gen_ai.request.stream": bool(params.get("stream")),
+            },
+        )
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs) -> None:
+        self._start_span(run_id, **kwargs)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs) -> None:
+        self._start_span(run_id, **kwargs)
+
+    def on_llm_end(self, response: LLMResult, *, run_id, **kwargs: Any) -> None:
+        span = self._spans.pop(run_id, None)
+        if span is None:
+            return
+
+        llm_output = response.llm_output or {}
+        token_usage = llm_output.get("token_usage") or {}
+        prompt_tokens = token_usage.get("prompt_tokens", 0)
+        completion_tokens = token_usage.get("completion_tokens", 0)
+        cached_tokens = (token_usage.get("prompt_tokens_details") or {}).get(
+            "cached_tokens"
+        )
+        span.set_attribute("gen_ai.usage.input_tokens", prompt_tokens)
+        span.set_attribute("gen_ai.usage.output_tokens", completion_tokens)
+        span.set_attribute("gen_ai.usage.cached_tokens", cached_tokens or 0)
+
+        model = llm_output.get("model_name")
+        if model:
+            span.set_attribute("gen_ai.response.model", model)
+            try:
+                cost = get_openai_token_cost_for_model(
+                    model, prompt_tokens
+                ) + get_openai_token_cost_for_model(
+                    model, completion_tokens, is_completion=True
+                )
+                span.set_attribute("llm.cost", cost)
+            except ValueError:
+                # Model without a known price
+                pass
+        span.end()
+
+    def on_llm_error(self, error: BaseException, *, run_id, **kwargs: Any) -> None:
+        span = self._spans.pop(run_id, None)
+        if span is not None:
+            record_error(span, error)
+            span.end()
+
 
 class DummyConversation:
     def __init__(self, model):
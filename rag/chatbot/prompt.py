@@ -0,0 +1,136 @@
+import logging
+from typing import List, Tuple
+
+import tiktoken
+
+from langchain.prompts import ChatPromptTemplate
+from langchain_core.messages import BaseMessage
+from langchain_community.adapters.openai import convert_message_to_dict
+
+from rag.config import PromptBudgetConfig
+from rag.chatbot.context import get_encoding
+
+logger = logging.getLogger(__name__)
+
+# Sections of the prompt, in the order in which they are trimmed when the
+# prompt exceeds its overall budget (lowest priority first).
+SECTION_PRIORITY = [
+    "chat_history",
+    "conversation_summary",
+    "context",
+    "general_condition",
+    "sum_insured",
+    "deductible",
+]
+
+# Tokens added by the chat format around every message and to prime the reply
+# https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+TOKENS_PER_MESSAGE = 3
+TOKENS_REPLY_PRIMING = 3
+
+
+def count_message_tokens(
+    encoding: tiktoken.Encoding, messages: List[BaseMessage]
+) -> int:
+    """Counts the tokens of the messages as sent to the chat completion API."""
+    num_tokens = 0
+    for message in messages:
+        num_tokens += TOKENS_PER_MESSAGE
+        for value in convert_message_to_dict(message).values():
+            if isinstance(value, str):
+                num_tokens += len(encoding.encode(value))
+    return num_tokens + TOKENS_REPLY_PRIMING
+
+
+class PromptBuilder:
+    """
+    Fits the variables of the chat prompt in a token budget.
+
+    Every section of the prompt is first capped to its own budget. If the
+    rendered prompt still exceeds `max_prompt_tokens`, the sections are trimmed
+    further following `SECTION_PRIORITY`: the oldest messages of the history
+    are dropped first, then the end of the conversation summary, of the
+    retrieved package chunks and of the general condition, and so on. The question is never trimmed.
+    """
+
+    def __init__(
+        self, prompt: ChatPromptTemplate, model: str, budget: PromptBudgetConfig
+    ):
+        """
+        :param prompt: The chat prompt template of the chain.
+        :param model: The LLM model, used to select the tiktoken encoding.
+        :param budget: The token budgets of the prompt.
+        """
+        self.prompt = prompt
+        self.encoding = get_encoding(model)
+        self.budget = budget
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.encoding.encode(text))
+
+    def count_message_tokens(self, messages: List[BaseMessage]) -> int:
+        return count_message_tokens(self.encoding, messages)
+
+    def count_section_tokens(self, value) -> int:
+        if isinstance(value, list):
+            return self.count_message_tokens(value) - TOKENS_REPLY_PRIMING
+        return self.count_tokens(str(value))
+
+    def trim_section(self, value, max_tokens: int):
+        """Trims a section to `max_tokens`: the oldest messages are dropped from
+        a history, and a text is truncated at the end."""
+        max_tokens = max(max_tokens, 0)
+        if isinstance(value, list):
+            messages = list(value)
+            while messages and self.count_section_tokens(messages) > max_tokens:
+                messages.pop(0)
+            return messages
+
+        tokens = self.encoding.encode(str(value))
+        if len(tokens) <= max_tokens:
+            return value
+        return self.encoding.decode(tokens[:max_tokens])
+
+    def build(self, variables: dict) -> Tuple[dict, int]:
+        """
+        Fits the variables of the prompt in the budget.
+
+        :param variables: The input variables of the chain.
+        :return: The trimmed variables and the number of tokens of the prompt.
+        """
+        variables = dict(variables)
+
+        # Per section budget
+        for section in SECTION_PRIORITY:
+            if section in variables:
+                variables[section] = self.trim_section(
+                    variables[section], getattr(self.budget, section)
+                )
+
+        prompt_tokens = self.count_message_tokens(
+            self.prompt.format_messages(**variables)
+        )
+
+        # Overall budget, the lowest priority sections are trimmed first
+        for section in SECTION_PRIORITY:
+            excess = prompt_tokens - self.budget.max_prompt_tokens
+            if excess <= 0:
+                break
+            if section not in variables:
+                continue
+            section_tokens = self.count_section_tokens(variables[section])
+            variables[section] = self.trim_section(
+                variables[section], section_tokens - excess
+            )
+            prompt_tokens = self.count_message_tokens(
+                self.prompt.format_messages(**variables)
+            )
+
+        if prompt_tokens > self.budget.max_prompt_tokens:
+            logger.warning(
+                "Prompt of %d tokens exceeds the budget of %d tokens",
+                prompt_tokens,
+                self.budget.max_prompt_tokens,
+            )
+
+        return variables, prompt_tokens
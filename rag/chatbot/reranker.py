@@ -0,0 +1,136 @@
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+from rag.constants import (
+    RERANK_MODEL_NAME,
+    RERANK_TIME_BUDGET,
+    RERANK_BATCH_SIZE,
+    RERANK_CACHE_SIZE,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class CrossEncoderReranker:
+    """
+    Reranks the candidates returned by the vector search with a CPU
+    cross-encoder, within a strict time budget per request.
+
+    Scores of (question, document) pairs are cached, and the uncached pairs
+    are scored in batches. Before every batch the reranker checks whether the
+    batch still fits in the remaining budget (based on the running average
+    batch time); if it does not, it gives up and the caller keeps the vector
+    order. The average is initialised by a warm-up batch of long documents
+    when the reranker is created, so that the first request is also bounded.
+    """
+
+    def __init__(
+        self,
+        model_name: str = RERANK_MODEL_NAME,
+        time_budget: float = RERANK_TIME_BUDGET,
+        batch_size: int = RERANK_BATCH_SIZE,
+        cache_size: int = RERANK_CACHE_SIZE,
+    ):
+        """
+        :param model_name: Name of the sentence-transformers cross-encoder.
+        :param time_budget: Maximum time in seconds spent reranking a request.
+        :param batch_size: Number of pairs scored per model call.
+        :param cache_size: Maximum number of cached (question, document) scores.
+        """
+        from sentence_transformers import CrossEncoder
+
+        self.model = CrossEncoder(model_name, device="cpu")
+        self.time_budget = time_budget
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._avg_batch_time = None
+        self.warm_up()
+
+    @staticmethod
+    def _cache_key(question: str, document: str) -> str:
+        return hashlib.sha256(f"{question}\0{document}".encode("utf-8")).hexdigest()
+
+    def _get_cached(self, key: str) -> Optional[float]:
+        with self._lock:
+            score = self._cache.get(key)
+            if score is not None:
+                self._cache.move_to_end(key)
+            return score
+
+    def _set_cached(self, key: str, score: float) -> None:
+        with self._lock:
+            self._cache[key] = score
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _update_batch_time(self, elapsed: float, n_pairs: int) -> None:
+        # Normalised to a full batch so that a short last batch does not skew it
+        batch_time = elapsed * self.batch_size / max(n_pairs, 1)
+        with self._lock:
+            if self._avg_batch_time is None:
+                self._avg_batch_time = batch_time
+            else:
+                self._avg_batch_time = 0.8 * self._avg_batch_time + 0.2 * batch_time
+
+    def warm_up(self) -> None:
+        """Scores a full batch of documents truncated at the maximum length of
+        the model, which initialises the average batch time with an upper
+        bound. The first call of the model, slower, is not timed."""
+        document = "warm-up " * 1000
+        pairs = [("warm-up", document)] * self.batch_size
+        self.model.predict(pairs, batch_size=self.batch_size, show_progress_bar=False)
+        start = time.perf_counter()
+        self.model.predict(pairs, batch_size=self.batch_size, show_progress_bar=False)
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self._avg_batch_time = None
+        self._update_batch_time(elapsed, len(pairs))
+        logger.info("Reranker warmed up, %.3f s per batch", elapsed)
+
+    def rerank(self, question: str, documents: List[str]) -> Optional[List[int]]:
+        """
+        Scores the documents against the question.
+
+        :param question: The user question.
+        :param documents: The candidate documents, in vector order.
+        :return: The indices of the documents sorted by decreasing relevance, or
+            `None` if the time budget was exceeded.
+        """
+        start = time.perf_counter()
+        keys = [self._cache_key(question, document) for document in documents]
+        scores = [self._get_cached(key) for key in keys]
+        missing = [i for i, score in enumerate(scores) if score is None]
+
+        for offset in range(0, len(missing), self.batch_size):
+            batch = missing[offset : offset + self.batch_size]
+            remaining = self.time_budget - (time.perf_counter() - start)
+            with self._lock:
+                avg_batch_time = self._avg_batch_time
+            if avg_batch_time is not None and avg_batch_time > remaining:
+                logger.info(
+                    "Rerank budget exceeded, %d/%d pairs unscored",
+                    len(missing) - offset,
+                    len(documents),
+                )
+                return None
+
+            batch_start = time.perf_counter()
+            batch_scores = self.model.predict(
+                [(question, documents[i]) for i in batch],
+                batch_size=self.batch_size,
+                show_progress_bar=False,
+            )
+            self._update_batch_time(time.perf_counter() - batch_start, len(batch))
+
+            for i, score in zip(batch, batch_scores):
+                scores[i] = float(score)
+                self._set_cached(keys[i], scores[i])
+
+        return sorted(range(len(documents)), key=lambda i: scores[i], reverse=True)
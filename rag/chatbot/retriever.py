@@ -1,13 +1,22 @@
 from __future__ import annotations
 
 import os
+import json
+import time
+import logging
+import hashlib
+import httpx
 import pandas as pd
 import chromadb
+from typing import List, Tuple
 from chromadb import Collection
 from chromadb.utils.embedding_functions import SentenceTransformerEmbeddingFunction
 from langchain_community.vectorstores import Chroma
 
 from rag.schema import InsuranceData
+from rag.chatbot.reranker import CrossEncoderReranker
+from rag.config import RetrievalServiceConfig
+from rag.tracing import tracer
 
 from rag.constants import (
     COL_INDEX,
@@ -18,12 +27,105 @@ from rag.constants import (
     COL_ARTICLE,
     COL_COMPANY,
     COL_EMBEDDINGS,
+    COL_CONTENT_HASH,
+    COLLECTION_VERSION_KEY,
+    COLLECTION_VERSION_CHECK_INTERVAL,
+    RERANK_CANDIDATES,
 )
 
+logger = logging.getLogger(__name__)
+
+METADATA_COLUMNS = [COL_TYPE, COL_CATEGORY, COL_PACKAGE, COL_ARTICLE, COL_COMPANY]
+
+# Host of the requests sent to the retrieval service over its Unix socket
+RETRIEVAL_SERVICE_SOCKET_URL = "http://retrieval-service"
+
+
+class RetrievalServiceClient:
+    """HTTP client of the retrieval service (`rag.retrieval_service`), used by
+    the client mode of `VectorZurichChromaDbClient`."""
+
+    def __init__(self, config: RetrievalServiceConfig):
+        self.config = config
+        self._http = self._connect()
+
+    def _connect(self) -> httpx.Client:
+        if self.config.socket_path:
+            return httpx.Client(
+                transport=httpx.HTTPTransport(uds=self.config.socket_path),
+                base_url=RETRIEVAL_SERVICE_SOCKET_URL,
+                timeout=self.config.timeout,
+            )
+        return httpx.Client(base_url=self.config.url, timeout=self.config.timeout)
+
+    def _call(self, method: str, path: str, **kwargs) -> dict:
+        with tracer.start_as_current_span(
+            "retrieval_service.call", attributes={"http.route": path}
+        ):
+            response = self._http.request(method, path, **kwargs)
+            response.raise_for_status()
+            return response.json()
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        return self._call("POST", "/embed", json={"texts": texts})["embeddings"]
+
+    def package_chunks(
+        self,
+        filter_packages: dict,
+        top_k: int,
+        user_question: str,
+        query_embedding: List[float] = None,
+    ) -> dict:
+        return self._call(
+            "POST",
+            "/package_chunks",
+            json={
+                "filter_packages": filter_packages,
+                "top_k": top_k,
+                "user_question": user_question,
+                "query_embedding": query_embedding,
+            },
+        )
+
+    def collection_version(self) -> int:
+        return self._call("GET", "/collection_version")["version"]
+
+    def general_condition_chunks(self) -> Tuple[int, dict]:
+        """Returns the collection version and the general condition chunks."""
+        data = self._call("GET", "/general_condition_chunks")
+        return data["version"], data["chunks"]
+
+    def release_connections(self):
+        """Closes the pooled connections, e.g. before a fork."""
+        self._http.close()
+        self._http = self._connect()
+
 
 class VectorZurichChromaDbClient:
-    def __init__(self, retriever: Collection):
+    """
+    Retrieval of the package and general condition documents from a Chroma
+    collection, or in client mode (`from_service`) from the shared retrieval
+    service owning the model and the index (`rag.retrieval_service`).
+    """
+
+    def __init__(
+        self,
+        retriever: Collection,
+        client: chromadb.ClientAPI = None,
+        embeddings: SentenceTransformerEmbeddingFunction = None,
+        reranker: CrossEncoderReranker = None,
+        rerank_candidates: int = RERANK_CANDIDATES,
+        service: RetrievalServiceClient = None,
+    ):
         self.retriever = retriever
+        self._client = client
+        self._embeddings = embeddings
+        self.reranker = reranker
+        self.rerank_candidates = rerank_candidates
+        self._service = service
+        self._general_condition_cache = None
+        # (time of the read, version)
+        self._version_cache = None
 
     @classmethod
     def get_retriever(
@@ -31,6 +133,7 @@ class VectorZurichChromaDbClient:
         db_path: str,
         collection_name: str,
         embeddings: SentenceTransformerEmbeddingFunction,
+        reranker: CrossEncoderReranker = None,
     ) -> VectorZurichChromaDbClient:
 
         client = chromadb.PersistentClient(path=db_path)
@@ -38,33 +141,224 @@ class VectorZurichChromaDbClient:
             name=collection_name, embedding_function=embeddings
         )
 
-        return cls(retriever)
+        retriever_client = cls(
+            retriever, client=client, embeddings=embeddings, reranker=reranker
+        )
+        # The SQLite connections must not be shared with forked workers
+        os.register_at_fork(before=retriever_client.release_connections)
+        return retriever_client
+
+    @classmethod
+    def from_service(
+        cls: VectorZurichChromaDbClient, config: RetrievalServiceConfig
+    ) -> VectorZurichChromaDbClient:
+        """Client mode: the retrieval is done by the retrieval service, the
+        model and the index are not loaded in this process."""
+        retriever_client = cls(None, service=RetrievalServiceClient(config))
+        os.register_at_fork(before=retriever_client.release_connections)
+        return retriever_client
+
+    def warm_up(self):
+        """Loads the embedding model, the vector index and the general
+        condition in memory, e.g. before the workers are forked."""
+        if self._service is not None:
+            return
+        sample = self.retriever.get(limit=1, include=["embeddings"])
+        if sample["ids"]:
+            self.embed_query("warm-up")
+            self.retriever.query(
+                query_embeddings=sample["embeddings"], n_results=1, include=[]
+            )
+        self.get_zurich_general_condition_chunks()
+
+    def release_connections(self):
+        """Closes the SQLite connections of the client (or the connections to
+        the retrieval service), reopened on use."""
+        if self._service is not None:
+            self._service.release_connections()
+        if self._client is not None:
+            # Not exposed by chromadb, the pool of its SQLite store (0.4.x)
+            system = getattr(self._client, "_system", None)
+            try:
+                from chromadb.db.impl.sqlite import SqliteDB
+
+                pool = system.instance(SqliteDB)._conn_pool
+            except (ImportError, AttributeError) as error:
+                logger.warning(
+                    "The SQLite connections of Chroma could not be closed, the "
+                    "forked workers may share them: %s",
+                    error,
+                )
+                return
+            pool.close()
+
+    @property
+    def collection_version(self) -> int:
+        """Version of the collection, bumped by `VectorDBCreator` on every
+        re-ingest that changed at least one document. The metadata is re-read
+        from the client, at most every `COLLECTION_VERSION_CHECK_INTERVAL`
+        seconds, so that a re-ingest done by another process is seen."""
+        now = time.monotonic()
+        cached = self._version_cache
+        if cached is not None and now - cached[0] < COLLECTION_VERSION_CHECK_INTERVAL:
+            return cached[1]
+
+        if self._service is not None:
+            version = self._service.collection_version()
+        else:
+            if self._client is not None:
+                metadata = self._client.get_collection(
+                    name=self.retriever.name
+                ).metadata
+            else:
+                metadata = self.retriever.metadata
+            version = (metadata or {}).get(COLLECTION_VERSION_KEY, 0)
+        self._version_cache = (now, version)
+        return version
+
+    def embed_query(self, user_question: str) -> List[float]:
+        """Embeds the question with the embedding function of the collection."""
+        with tracer.start_as_current_span("retriever.embed_query"):
+            return self.embed_texts([user_question])[0]
+
+    def embed_texts(self, texts: List[str]) -> List[List[float]]:
+        if self._service is not None:
+            return self._service.embed(texts)
+        return [
+            [float(value) for value in embedding]
+            for embedding in self._embeddings(texts)
+        ]
+
+    def get_zurich_package_chunks(
+        self,
+        filter_packages: dict,
+        top_k: int,
+        user_question: str,
+        query_embedding: List[float] = None,
+    ) -> dict:
+        """Retrieves the `top_k` package documents most relevant to the question.
+
+        Args:
+            filter_packages (dict): `where` filter on the packages of the user.
+            top_k (int): number of documents to return.
+            user_question (str): the question of the user.
+            query_embedding (List[float]): embedding of the question, embedded
+            by the collection if not given.
+
+        Returns:
+            dict: the `ids`, `documents` and stored `embeddings` of the
+            retrieved documents, most relevant first.
+        """
+        if self._service is not None:
+            # Retrieved and reranked by the service
+            return self._service.package_chunks(
+                filter_packages=filter_packages,
+                top_k=top_k,
+                user_question=user_question,
+                query_embedding=query_embedding,
+            )
+
+        # With a reranker, a wider candidate set is retrieved and reranked
+        n_results = top_k
+        if self.reranker is not None:
+            n_results = max(top_k, self.rerank_candidates)
+
+        if query_embedding is not None:
+            query = {"query_embeddings": [query_embedding]}
+        else:
+            query = {"query_texts": user_question}
+
+        with tracer.start_as_current_span(
+            "retriever.query",
+            attributes={"retriever.top_k": top_k, "retriever.n_results": n_results},
+        ) as span:
+            data_retriever = self.retriever.query(
+                **query,
+                n_results=n_results,
+                where=filter_packages,
+                include=["documents", "embeddings"],
+            )
+            span.set_attribute("retriever.results", len(data_retriever["ids"][0]))
+
+        list_ids_retriever = data_retriever.get("ids")[0]
+        list_documents_retriver = data_retriever.get("documents")[0]
+        list_embeddings_retriever = data_retriever.get("embeddings")[0]
+
+        order = list(range(len(list_ids_retriever)))
+        if self.reranker is not None and len(list_documents_retriver) > 1:
+            with tracer.start_as_current_span(
+                "retriever.rerank",
+                attributes={"retriever.candidates": len(list_documents_retriver)},
+            ) as span:
+                reranked = self.reranker.rerank(user_question, list_documents_retriver)
+                span.set_attribute("retriever.rerank_completed", reranked is not None)
+            # Falls back to the vector order if the rerank budget was exceeded
+            order = reranked or order
+        order = order[:top_k]
+
+        return {
+            "ids": [list_ids_retriever[i] for i in order],
+            "documents": [list_documents_retriver[i] for i in order],
+            "embeddings": [list_embeddings_retriever[i] for i in order],
+        }
 
     def get_zurich_package_info(
         self, filter_packages: dict, top_k: int, user_question: str
     ) -> str:
-        data_retriever = self.retriever.query(
-            query_texts=user_question, n_results=top_k, where=filter_packages
+        package_chunks = self.get_zurich_package_chunks(
+            filter_packages=filter_packages, top_k=top_k, user_question=user_question
         )
-        
-        list_ids_retriever = data_retriever.get("ids")[0]
-        list_documents_retriver = data_retriever.get("documents")[0]
-        
-        data_string_document = "\n".join(list_documents_retriver)
 
-        return data_string_document, list_ids_retriever
+        data_string_document = "\n".join(package_chunks["documents"])
+
+        return data_string_document, package_chunks["ids"]
+
+    def get_zurich_general_condition_chunks(self) -> dict:
+        """Returns the `ids`, `documents` and stored `embeddings` of the general
+        condition."""
+        # The general condition only changes when the collection is re-ingested,
+        # so it is cached until the collection version is bumped.
+        version = self.collection_version
+        if (
+            self._general_condition_cache is not None
+            and self._general_condition_cache[0] == version
+        ):
+            return self._general_condition_cache[1]
+
+        if self._service is not None:
+            self._general_condition_cache = self._service.general_condition_chunks()
+            return self._general_condition_cache[1]
+
+        with tracer.start_as_current_span("retriever.general_condition") as span:
+            general_condition_retriever = self.retriever.get(
+                where={"mapping_package": {"$eq": [0]}},
+                include=["documents", "embeddings"],
+            )
+            span.set_attribute(
+                "retriever.results", len(general_condition_retriever["ids"])
+            )
+        general_condition_chunks = {
+            "ids": general_condition_retriever.get("ids"),
+            "documents": general_condition_retriever.get("documents"),
+            "embeddings": general_condition_retriever.get("embeddings"),
+        }
+        self._general_condition_cache = (version, general_condition_chunks)
+        return general_condition_chunks
 
     def get_zurich_general_condition(self):
-        general_condition_retriever = self.retriever.get(
-            where={"mapping_package": {"$eq": [0]}}
-        )
-        return "\n".join(general_condition_retriever.get("documents"))
+        return "\n".join(self.get_zurich_general_condition_chunks()["documents"])
 
 
 class VectorDBCreator:
-    def __init__(self, db_path: str, collection_name: str):
+    def __init__(
+        self,
+        db_path: str,
+        collection_name: str,
+        embeddings: SentenceTransformerEmbeddingFunction = None,
+    ):
         self._set_db_path(db_path)
         self._set_collection_name(collection_name)
+        self._embeddings = embeddings
         self._chroma_client = chromadb.PersistentClient(path=self.db_path)
 
     @property
@@ -98,6 +392,16 @@ class VectorDBCreator:
         """Validates a DataFrame against the InsuranceData schema."""
         return InsuranceData.validate(df)
 
+    @staticmethod
+    def compute_content_hash(df: pd.DataFrame) -> pd.Series:
+        """Computes a SHA-256 hash of the text and metadata of every row."""
+        return df[[COL_TEXT] + METADATA_COLUMNS].apply(
+            lambda row: hashlib.sha256(
+                json.dumps(row.tolist(), default=str).encode("utf-8")
+            ).hexdigest(),
+            axis=1,
+        )
+
     @classmethod
     def create_collection_from_excel(
         cls, db_path: str, collection_name: str, filepath: str
@@ -109,6 +413,21 @@ class VectorDBCreator:
         creator.initialize_collection()
         creator.add_insurance_data_to_collection(validated_df)
 
+    @classmethod
+    def update_collection_from_excel(
+        cls,
+        db_path: str,
+        collection_name: str,
+        filepath: str,
+        embeddings: SentenceTransformerEmbeddingFunction = None,
+    ) -> dict:
+        """Incrementally re-ingests an Excel file into an existing collection."""
+        df = pd.read_excel(filepath)
+        validated_df = cls.validate_dataframe(df)
+        creator = cls(db_path, collection_name, embeddings=embeddings)
+        creator.initialize_collection()
+        return creator.sync_insurance_data_to_collection(validated_df)
+
     def initialize_collection(self):
         """Initializes the collection in ChromaDB."""
         if self.collection_name not in self._chroma_client.list_collections():
@@ -117,11 +436,93 @@ class VectorDBCreator:
     def add_insurance_data_to_collection(self, df: pd.DataFrame):
         """Adds insurance data to the collection."""
         collection = self._chroma_client.get_collection(self.collection_name)
+        df = df.assign(**{COL_CONTENT_HASH: self.compute_content_hash(df)})
         collection.add(
             ids=df[COL_INDEX].tolist(),
             embeddings=df[COL_EMBEDDINGS].tolist(),
-            metadatas=df[
-                [COL_TYPE, COL_CATEGORY, COL_PACKAGE, COL_ARTICLE, COL_COMPANY]
-            ].to_dict("records"),
+            metadatas=df[METADATA_COLUMNS + [COL_CONTENT_HASH]].to_dict("records"),
             documents=df[COL_TEXT].tolist(),
         )
+
+    def sync_insurance_data_to_collection(self, df: pd.DataFrame) -> dict:
+        """Diffs the data against the collection using the content hash stored
+        in the metadata of every document. Only new or changed rows are
+        (re-)embedded and upserted, and documents missing from the data are
+        deleted. The collection version is bumped if anything changed.
+
+        Args:
+            df (pd.DataFrame): validated insurance data. If it has no
+            embeddings column, the embedding function of the creator is used
+            for the changed rows, and is then required.
+
+        Returns:
+            dict: number of upserted, deleted and unchanged documents and the
+            resulting collection version.
+        """
+        if COL_EMBEDDINGS not in df.columns and self._embeddings is None:
+            # Chroma would embed the rows with its default model, not the one
+            # of the questions
+            raise ValueError(
+                "The data has no embeddings column, an embedding function is "
+                "required to embed the changed rows"
+            )
+        if self._embeddings is not None:
+            collection = self._chroma_client.get_collection(
+                self.collection_name, embedding_function=self._embeddings
+            )
+        else:
+            collection = self._chroma_client.get_collection(self.collection_name)
+
+        existing = collection.get(include=["metadatas"])
+        existing_hashes = {
+            doc_id: (metadata or {}).get(COL_CONTENT_HASH)
+            for doc_id, metadata in zip(existing["ids"], existing["metadatas"])
+        }
+
+        df = df.assign(
+            **{
+                COL_INDEX: df[COL_INDEX].astype(str),
+                COL_CONTENT_HASH: self.compute_content_hash(df),
+            }
+        )
+        changed = df[
+            [
+                existing_hashes.get(doc_id) != content_hash
+                for doc_id, content_hash in zip(df[COL_INDEX], df[COL_CONTENT_HASH])
+            ]
+        ]
+        removed_ids = sorted(set(existing_hashes) - set(df[COL_INDEX]))
+
+        if not changed.empty:
+            collection.upsert(
+                ids=changed[COL_INDEX].tolist(),
+                embeddings=(
+                    changed[COL_EMBEDDINGS].tolist()
+                    if COL_EMBEDDINGS in changed.columns
+                    else None
+                ),
+                metadatas=changed[METADATA_COLUMNS + [COL_CONTENT_HASH]].to_dict(
+                    "records"
+                ),
+                documents=changed[COL_TEXT].tolist(),
+            )
+
+        if removed_ids:
+            collection.delete(ids=removed_ids)
+
+        version = (collection.metadata or {}).get(COLLECTION_VERSION_KEY, 0)
+        if not changed.empty or removed_ids:
+            version += 1
+            collection.modify(
+                metadata={
+                    **(collection.metadata or {}),
+                    COLLECTION_VERSION_KEY: version,
+                }
+            )
+
+        return {
+            "upserted": len(changed),
+            "deleted": len(removed_ids),
+            "unchanged": len(df) - len(changed),
+            "collection_version": version,
+        }
@@ -0,0 +1,83 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, Tuple
+
+from rag.constants import CHAT_COALESCE_TTL
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into a single computation.
+
+    The first call (the leader) runs the computation in its own task, so that
+    it completes even if the leader is cancelled (e.g. the client
+    disconnects), and the duplicates await the same task. With `keep_result`
+    the result is kept for `ttl` seconds, so that a retry arriving just after
+    the computation ended also reuses it. Failures are not kept.
+
+    The coalescing is per process: duplicates sent to different workers are
+    computed twice.
+    """
+
+    def __init__(self, ttl: float = CHAT_COALESCE_TTL):
+        """
+        :param ttl: Seconds a result is reused after its computation ended.
+        """
+        self.ttl = ttl
+        self._tasks = {}
+        # key -> (expiry, result), in expiry order
+        self._results = OrderedDict()
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        while self._results:
+            key, (expiry, _) = next(iter(self._results.items()))
+            if expiry > now:
+                break
+            self._results.popitem(last=False)
+
+    def _on_done(self, key: Hashable, task: asyncio.Task, keep_result: bool):
+        self._tasks.pop(key, None)
+        if (
+            keep_result
+            and not task.cancelled()
+            and task.exception() is None
+            and self.ttl > 0
+        ):
+            self._results[key] = (time.monotonic() + self.ttl, task.result())
+
+    async def do(
+        self, key: Hashable, fn: Callable[[], Awaitable[Any]], keep_result: bool = True
+    ) -> Tuple[Any, bool]:
+        """
+        Runs `fn` once for all the concurrent calls with the same key.
+
+        :param key: The key of the computation.
+        :param fn: The coroutine function computing the result.
+        :param keep_result: Reuse the result for `ttl` seconds after the
+            computation ended. Otherwise only the calls arriving while it runs
+            share it.
+        :return: The result, and whether it was shared with (computed by)
+            another call.
+        """
+        self._evict_expired()
+        if keep_result and key in self._results:
+            logger.info("Reusing the recent result of %s", key)
+            return self._results[key][1], True
+
+        task = self._tasks.get(key)
+        shared = task is not None
+        if shared:
+            logger.info("Coalescing with the in-flight computation of %s", key)
+        else:
+            task = asyncio.ensure_future(fn())
+            self._tasks[key] = task
+            task.add_done_callback(
+                lambda done: self._on_done(key, done, keep_result)
+            )
+
+        return await asyncio.shield(task), shared
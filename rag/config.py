@@ -2,7 +2,8 @@ from __future__ import annotations
 
 from pydantic import BaseModel, Field, model_serializer
 from rag.utils import load_conf
-from typing import List
+from rag.constants import SERVER_THREADS_PER_WORKER
+from typing import ClassVar, List, Optional
 
 # from pydantic import BaseModel
 import os
@@ -23,6 +24,11 @@ class ConversationUpdateRequest(BaseModel):
 class ChatQuestion(BaseModel):
     question: str
     conversation_uuid: str
+    # The `chat_history` of the response holds the messages after this id
+    # (the last one the client has), by default only the new turn
+    since_message_id: Optional[int] = Field(default=None, ge=0)
+    # All the messages of the conversation in the `chat_history`
+    full_history: bool = Field(default=False)
 
 
 class BaseOpenAIConfig(BaseModel):
@@ -31,6 +37,8 @@ class BaseOpenAIConfig(BaseModel):
     api_key: str = Field(...)
     max_retries: int = Field(default=3)
     timeout: int = Field(default=40)
+    # OpenAI-compatible endpoint, e.g. the local fake LLM of `rag.fakes`
+    base_url: Optional[str] = Field(default=None)
 
     @classmethod
     def load_from_yaml(
@@ -54,9 +62,10 @@ class BaseOpenAIConfig(BaseModel):
     ) -> AzureChatOpenAIConfig:
         load_dotenv(env_file)
         return cls(
-            model_name=os.getenv("MODEL_NAME"),
+            model=os.getenv("MODEL_NAME"),
             temperature=float(os.getenv("TEMPERATURE", 0)),
-            openai_api_key=os.getenv("OPENAI_API_KEY"),
+            api_key=os.getenv("OPENAI_API_KEY"),
+            base_url=os.getenv("OPENAI_BASE_URL"),
         )
 
 
@@ -69,9 +78,11 @@ class AzureChatOpenAIConfig(BaseOpenAIConfig):
     @model_serializer
     def serialize_model(self):
         return {
-            "model_name": self.model_name,
+            "model": self.model,
             "temperature": self.temperature,
-            "openai_api_key": self.openai_api_key,
+            "api_key": self.api_key,
+            "max_retries": self.max_retries,
+            "timeout": self.timeout,
             "azure_endpoint": self.azure_endpoint,
             "api_version": self.api_version,
             "azure_deployment": self.azure_deployment,
@@ -83,15 +94,184 @@ class AzureChatOpenAIConfig(BaseOpenAIConfig):
     ) -> AzureChatOpenAIConfig:
         load_dotenv(env_file)
         return cls(
-            model_name=os.getenv("MODEL_NAME"),
+            model=os.getenv("MODEL_NAME"),
             temperature=float(os.getenv("TEMPERATURE", 0)),
-            openai_api_key=os.getenv("OPENAI_API_KEY"),
+            api_key=os.getenv("OPENAI_API_KEY"),
             azure_endpoint=os.getenv("AZURE_ENDPOINT"),
             api_version=os.getenv("API_VERSION"),
             azure_deployment=os.getenv("AZURE_DEPLOYMENT"),
         )
 
 
+class EnvConfig(BaseModel):
+    """Settings loaded from the `<env_prefix><FIELD>` environment variables."""
+
+    env_prefix: ClassVar[str] = ""
+
+    @classmethod
+    def load_from_env(cls, env_file: str = ".env"):
+        """Loads the settings from the `<env_prefix><FIELD>` variables, the
+        unset ones keeping their default."""
+        load_dotenv(env_file)
+        return cls(
+            **{
+                name: os.getenv(f"{cls.env_prefix}{name.upper()}")
+                for name in cls.model_fields
+                if os.getenv(f"{cls.env_prefix}{name.upper()}")
+            }
+        )
+
+
+class PromptBudgetConfig(EnvConfig):
+    """Token budget of the prompt, overall and per section of the template."""
+
+    env_prefix: ClassVar[str] = "PROMPT_BUDGET_"
+
+    max_prompt_tokens: int = Field(default=6000)
+    deductible: int = Field(default=500)
+    sum_insured: int = Field(default=500)
+    context: int = Field(default=2000)
+    general_condition: int = Field(default=3000)
+    chat_history: int = Field(default=1000)
+    conversation_summary: int = Field(default=500)
+
+
+class LLMGatewayConfig(EnvConfig):
+    """Admission control of the LLM calls."""
+
+    env_prefix: ClassVar[str] = "LLM_GATEWAY_"
+
+    max_concurrency: int = Field(default=8, ge=1)
+    max_queue_size: int = Field(default=32, ge=0)
+    max_wait: float = Field(default=10.0, gt=0)
+
+
+class HTTPClientConfig(EnvConfig):
+    """Pooled HTTP client shared by the LLM calls."""
+
+    env_prefix: ClassVar[str] = "LLM_HTTP_"
+
+    max_connections: int = Field(default=100, ge=1)
+    max_keepalive_connections: int = Field(default=20, ge=0)
+    keepalive_expiry: float = Field(default=60.0, ge=0)
+    # Used if the `h2` package is installed
+    http2: bool = Field(default=True)
+    connect_timeout: float = Field(default=5.0, gt=0)
+    # Between two chunks of the response, i.e. also the time to first token.
+    # The `timeout` of the LLM configs if unset
+    read_timeout: Optional[float] = Field(default=None, gt=0)
+    pool_timeout: float = Field(default=5.0, gt=0)
+
+
+class WriteBehindConfig(EnvConfig):
+    """Write-behind persistence of the chat messages."""
+
+    env_prefix: ClassVar[str] = "WRITE_BEHIND_"
+
+    spool_path: str = Field(default="./spool/messages.jsonl")
+    batch_size: int = Field(default=100, ge=1)
+    flush_interval: float = Field(default=0.05, ge=0)
+    # fsync the spool before acknowledging a turn, survives a host crash
+    fsync: bool = Field(default=True)
+
+
+class FakeLLMConfig(EnvConfig):
+    """Behaviour of the local OpenAI-compatible fake LLM (`rag.fakes.llm`)."""
+
+    env_prefix: ClassVar[str] = "FAKE_LLM_"
+
+    time_to_first_token: float = Field(default=0.5, ge=0)
+    tokens_per_second: float = Field(default=50.0, gt=0)
+    error_rate: float = Field(default=0.0, ge=0.0, le=1.0)
+    # Seed of the errors, the answers only depend on the messages
+    seed: int = Field(default=0)
+
+
+class ProfilerConfig(EnvConfig):
+    """On-demand sampling profiler of single requests (`rag.profiling`)."""
+
+    env_prefix: ClassVar[str] = "PROFILER_"
+
+    enabled: bool = Field(default=True)
+    # Seconds between two samples of the stacks
+    interval: float = Field(default=0.005, gt=0)
+    # Sampling stops after this many seconds, even if the request is running
+    max_duration: float = Field(default=30.0, gt=0)
+    # Seconds between the start of two profiles, only one runs at a time
+    min_interval: float = Field(default=10.0, ge=0)
+    # Profiles kept in memory, the oldest are dropped first
+    max_profiles: int = Field(default=20, ge=1)
+    # Also write the profiles to this directory
+    output_dir: Optional[str] = Field(default=None)
+    # Key of the signed `X-Profile-Signature` header, disabled if unset
+    secret: Optional[str] = Field(default=None)
+
+
+class TracingConfig(EnvConfig):
+    """OpenTelemetry tracing of the requests (`rag.tracing`)."""
+
+    env_prefix: ClassVar[str] = "TRACING_"
+
+    # none, console, file (JSON lines) or otlp (gRPC to a collector)
+    exporter: str = Field(default="none", pattern="^(none|console|file|otlp)$")
+    file_path: str = Field(default="./traces.jsonl")
+    otlp_endpoint: str = Field(default="http://localhost:4317")
+    # Ratio of the traces sampled, unless the caller already decided it
+    sample_ratio: float = Field(default=1.0, ge=0.0, le=1.0)
+    service_name: str = Field(default="insurchat")
+
+
+class QueryStatsConfig(EnvConfig):
+    """Statistics and slow-query log of the SQL statements (`rag.query_stats`)."""
+
+    env_prefix: ClassVar[str] = "QUERY_STATS_"
+
+    # Seconds above which a statement is logged with its plan
+    slow_query_threshold: float = Field(default=0.1, ge=0)
+    explain: bool = Field(default=True)
+    # Seconds between two plans of the same statement
+    explain_interval: float = Field(default=60.0, ge=0)
+    # Statements tracked, the others are counted together
+    max_fingerprints: int = Field(default=500, ge=1)
+
+
+class ServerConfig(EnvConfig):
+    """Production server forking the app workers (`rag.serve`)."""
+
+    env_prefix: ClassVar[str] = "SERVER_"
+
+    # b2c or dummy
+    app: str = Field(default="b2c", pattern="^(b2c|dummy)$")
+    host: str = Field(default="0.0.0.0")
+    port: int = Field(default=8001, ge=0, le=65535)
+    workers: int = Field(default=2, ge=1)
+    # So that the workers do not oversubscribe the cores
+    threads_per_worker: int = Field(default=SERVER_THREADS_PER_WORKER, ge=1)
+    # Seconds given to the in-flight requests on SIGTERM
+    graceful_timeout: float = Field(default=30.0, ge=0)
+
+
+class RetrievalServiceConfig(EnvConfig):
+    """Shared embedding and retrieval service (`rag.retrieval_service`), and
+    the client mode of `VectorZurichChromaDbClient` using it."""
+
+    env_prefix: ClassVar[str] = "RETRIEVAL_SERVICE_"
+
+    # Unix socket of the service, preferred over `url` when both are set
+    socket_path: Optional[str] = Field(default=None)
+    url: Optional[str] = Field(default=None)
+    # Seconds before a call of the client fails
+    timeout: float = Field(default=10.0, gt=0)
+    # The embeddings of the concurrent requests are computed in one batch of
+    # at most `max_batch_size` texts, waiting at most `max_wait` seconds
+    max_batch_size: int = Field(default=32, ge=1)
+    max_wait: float = Field(default=0.005, ge=0)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.socket_path or self.url)
+
+
 class VectorDatabaseFilter(BaseModel):
     mapping_package: List = None
 
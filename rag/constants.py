@@ -2,6 +2,17 @@ DEBUG_MODE = False
 DB_PATH = "./db_test"
 COLLECTION_NAME = "Collection1"
 MODEL_NAME = "manu/sentence_croissant_alpha_v0.4"
+RERANK_MODEL_NAME = "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1"
+RERANK_CANDIDATES = 10
+RERANK_TIME_BUDGET = 0.2  # seconds
+RERANK_BATCH_SIZE = 8
+RERANK_CACHE_SIZE = 10000
+CONTEXT_MMR_LAMBDA = 0.7
+CONTEXT_DUPLICATE_THRESHOLD = 0.95
+CONTEXT_MAX_GENERAL_CHUNKS = 5
+CONTEXT_STATIC_GENERAL_CONDITION = False  # whole general condition instead of MMR
+CHAT_COALESCE_TTL = 10.0  # seconds a chat response is reused by its idempotent retries
+SERVER_THREADS_PER_WORKER = 1  # torch and BLAS threads of every server worker
 FILENAME_DATASET_RAG = "./data/dataset_RAG.xlsx"
 
 COL_INDEX = "index"
@@ -12,3 +23,7 @@ COL_PACKAGE = "package"
 COL_ARTICLE = "article"
 COL_COMPANY = "company"
 COL_EMBEDDINGS = "embeddingd"
+COL_CONTENT_HASH = "content_hash"
+
+COLLECTION_VERSION_KEY = "collection_version"
+COLLECTION_VERSION_CHECK_INTERVAL = 5.0  # seconds between reads of the version
@@ -63,6 +63,22 @@ class ConversationMessage(Base):
     conversation = relationship("Conversation", back_populates="messages")
 
 
+class ConversationSummary(Base):
+    __tablename__ = os.getenv(
+        "TABLE_NAME_CONVERSATION_SUMMARIES", "conversation_summaries"
+    )
+    id = Column(Integer, primary_key=True)
+    conversation_uuid = Column(
+        UUID(as_uuid=True), ForeignKey(Conversation.uuid), unique=True, nullable=False
+    )
+    summary = Column(Text, nullable=False)
+    # Id of the last message folded into the summary
+    last_message_id = Column(Integer, nullable=False)
+    tokens = Column(Integer, nullable=False)
+    cost = Column(Float, nullable=False)
+    updated_at = Column(TIMESTAMP, server_default=func.now())
+
+
 class Package(Base):
     __tablename__ = "package"
     id = Column(Integer, primary_key=True)
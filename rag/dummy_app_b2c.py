@@ -6,6 +6,7 @@ from fastapi import FastAPI, Body, HTTPException, Query, status, Depends
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy import create_engine
+from langchain_core.messages import AIMessage, HumanMessage
 
 from rag.datamodels import Base
 from rag.auth import decode_token
@@ -19,7 +20,6 @@ from rag.config import (
 )
 
 
-from langchain_core.messages import message_to_dict
 
 
 # Create an instance of the Postgres class
@@ -53,9 +53,9 @@ async def chat(question: ChatQuestion = Body(...), playload=Depends(decode_token
     This endpoint receives a chat question encapsulated in a Pydantic model along with the
     user's token payload obtained via dependency injection. It first verifies if the user is
     the owner of the specified conversation using the provided token. If not, it returns a 403 Forbidden error.
-    Upon successful ownership verification, the method retrieves the chat history, processes the chat question,
-    updates the chat history with the new question and its response, and returns the chat response along with
-    the chat history.
+    Upon successful ownership verification, the method processes the chat question, updates the chat history
+    with the new question and its response, and returns the chat response along with the chat history: only the
+    new turn by default, the messages after `since_message_id`, or all of them with `full_history`.
 
     Parameters:
     - question (ChatQuestion): A Pydantic model representing the chat question details, including user ID,
@@ -64,8 +64,8 @@ async def chat(question: ChatQuestion = Body(...), playload=Depends(decode_token
       user ownership of the conversation.
 
     Returns:
-    - JSONResponse: A JSON response containing the original question, the chat response, the chat history,
-      and token usage statistics.
+    - JSONResponse: A JSON response containing the original question, the chat response, the chat history
+      with the message ids, the id of the last message and token usage statistics.
 
     Example of output:
     ```
@@ -73,9 +73,10 @@ async def chat(question: ChatQuestion = Body(...), playload=Depends(decode_token
         "question": "What is the weather like today?",
         "response": "The weather is sunny with a slight chance of rain in the afternoon.",
         "chat_history": [
-            {"user": "Human", "message": "Hello, what's the weather today?"},
-            {"user": "AI", "message": "The weather is sunny with a slight chance of rain in the afternoon."}
+            {"id": 41, "type": "human", "data": {"content": "What is the weather like today?", "type": "human", ...}},
+            {"id": 42, "type": "ai", "data": {"content": "The weather is sunny with a slight chance of rain in the afternoon.", "type": "ai", ...}}
         ],
+        "last_message_id": 42,
         "total_tokens": 50,
         "total_cost": 444
     }
@@ -97,21 +98,29 @@ async def chat(question: ChatQuestion = Body(...), playload=Depends(decode_token
         table_name=os.getenv("TABLE_NAME_CONVERSATION_MESSAGES"),
     )
 
-    chat_history_dict = [message_to_dict(message) for message in chat_memory.messages]
-
     res = chain_debug(question.question)
 
-    chat_memory.add_user_message(
-        message=question.question, tokens=res.get("prompt_tokens"), cost=0
-    )
-    chat_memory.add_ai_message(
-        message=res.get("answer"), tokens=res.get("completion_tokens"), cost=0
+    turn = [
+        (HumanMessage(content=question.question), res.get("prompt_tokens"), 0),
+        (AIMessage(content=res.get("answer")), res.get("completion_tokens"), 0),
+    ]
+    question_message_id, response_message_id = chat_memory.add_messages_with_usage(turn)
+
+    # Only the new turn by default, the client has the earlier messages
+    after_id = question_message_id - 1
+    if question.full_history:
+        after_id = None
+    elif question.since_message_id is not None:
+        after_id = question.since_message_id
+    chat_history_dict = chat_memory.get_message_dicts(
+        after_id=after_id, until_id=response_message_id
     )
 
     response_json = {
         "question": question.question,
         "response": res.get("answer"),
         "chat_history": chat_history_dict,
+        "last_message_id": response_message_id,
         "total_tokens": res.get("completion_tokens") + res.get("prompt_tokens"),
         "total_cost": 444,
     }
@@ -141,8 +150,9 @@ async def create_new_conversation(playload=Depends(decode_token)):
         "conversation_uuid": "a1b2c3d4-e5f6-7890-g1h2-i3j4k5l6m7n8",
         "conversation_name": "conv_20230401_153045",
         "chat_history": [
-            {"user": "AI", "message": "Bienvenu chez Insurapolis, comment puis-je vous aider ?"}
+            {"id": 1, "type": "ai", "data": {"content": "Bienvenu chez Insurapolis, comment puis-je vous aider ?", "type": "ai", ...}}
         ],
+        "last_message_id": 1,
     }
     ```
 
@@ -170,15 +180,14 @@ async def create_new_conversation(playload=Depends(decode_token)):
             tokens=12,
         )
 
-        chat_history_dict = [
-            message_to_dict(message) for message in chat_memory.messages
-        ]
+        chat_history_dict = chat_memory.get_message_dicts()
 
         response_data = {
             "user_email": playload["email"],
             "conversation_uuid": conv_uuid,
             "conversation_name": conv_name,
             "chat_history": chat_history_dict,
+            "last_message_id": chat_history_dict[-1]["id"],
         }
 
         return JSONResponse(content=response_data, status_code=status.HTTP_200_OK)
@@ -0,0 +1,127 @@
+"""Local in-memory stand-in for the DynamoDB API, to test the authorization of
+the managed clients without AWS.
+
+Implements the `CreateTable`, `DescribeTable`, `PutItem`, `GetItem` and
+`DeleteItem` operations of the DynamoDB JSON protocol, enough for boto3.
+
+Example:
+
+    python -m rag.fakes.dynamodb --port 8003
+
+with, in the `.env` file of the app:
+
+    DYNAMO_DB_ENDPOINT_URL=http://localhost:8003
+"""
+
+import json
+import argparse
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+CONTENT_TYPE = "application/x-amz-json-1.0"
+
+
+def error(type_: str, message: str) -> JSONResponse:
+    return JSONResponse(
+        status_code=400,
+        content={
+            "__type": f"com.amazonaws.dynamodb.v20120810#{type_}",
+            "message": message,
+        },
+        media_type=CONTENT_TYPE,
+    )
+
+
+class FakeDynamoDB:
+    """Tables of items, stored with their typed attributes."""
+
+    def __init__(self):
+        # table name -> {"schema": key attribute names, "items": {key: item}}
+        self.tables = {}
+
+    def _table(self, name: str):
+        if name not in self.tables:
+            raise KeyError(name)
+        return self.tables[name]
+
+    @staticmethod
+    def _key(table: dict, item: dict) -> str:
+        return json.dumps([item[name] for name in table["schema"]], sort_keys=True)
+
+    def _description(self, name: str) -> dict:
+        table = self.tables[name]
+        return {
+            "TableName": name,
+            "TableStatus": "ACTIVE",
+            "KeySchema": table["key_schema"],
+            "ItemCount": len(table["items"]),
+        }
+
+    def create_table(self, body: dict) -> dict:
+        name = body["TableName"]
+        self.tables[name] = {
+            "key_schema": body["KeySchema"],
+            "schema": [key["AttributeName"] for key in body["KeySchema"]],
+            "items": {},
+        }
+        return {"TableDescription": self._description(name)}
+
+    def describe_table(self, body: dict) -> dict:
+        self._table(body["TableName"])
+        return {"Table": self._description(body["TableName"])}
+
+    def put_item(self, body: dict) -> dict:
+        table = self._table(body["TableName"])
+        table["items"][self._key(table, body["Item"])] = body["Item"]
+        return {}
+
+    def get_item(self, body: dict) -> dict:
+        table = self._table(body["TableName"])
+        item = table["items"].get(self._key(table, body["Key"]))
+        return {"Item": item} if item is not None else {}
+
+    def delete_item(self, body: dict) -> dict:
+        table = self._table(body["TableName"])
+        table["items"].pop(self._key(table, body["Key"]), None)
+        return {}
+
+
+def create_app(fake_dynamodb: FakeDynamoDB) -> FastAPI:
+    app = FastAPI()
+    operations = {
+        "CreateTable": fake_dynamodb.create_table,
+        "DescribeTable": fake_dynamodb.describe_table,
+        "PutItem": fake_dynamodb.put_item,
+        "GetItem": fake_dynamodb.get_item,
+        "DeleteItem": fake_dynamodb.delete_item,
+    }
+
+    @app.post("/")
+    async def dispatch(request: Request):
+        # e.g. "DynamoDB_20120810.GetItem"
+        operation = request.headers.get("x-amz-target", "").split(".")[-1]
+        if operation not in operations:
+            return error("UnknownOperationException", f"Unsupported {operation}")
+        body = json.loads(await request.body())
+        try:
+            result = operations[operation](body)
+        except KeyError:
+            return error("ResourceNotFoundException", "Requested resource not found")
+        return JSONResponse(content=result, media_type=CONTENT_TYPE)
+
+    return app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8003)
+    args = parser.parse_args(argv)
+
+    uvicorn.run(create_app(FakeDynamoDB()), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
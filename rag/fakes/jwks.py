@@ -0,0 +1,125 @@
+"""Local stand-in for the Cognito JWKS endpoint, to test the authentication and
+to load test the API without Cognito.
+
+Serves `/.well-known/jwks.json` with the public keys of RSA keys stored in a
+PEM file (created if missing), and can mint the matching tokens. `POST
+/rotate` adds a new signing key, to test the key rotation.
+
+Example:
+
+    python -m rag.fakes.jwks --port 8002 --key-file ./fake_jwks.pem
+
+with, in the `.env` file of the app:
+
+    COGNITO_ISSUER=http://localhost:8002
+    COGNITO_JWKS_URI=http://localhost:8002/.well-known/jwks.json
+"""
+
+import json
+import time
+import uuid
+import argparse
+from pathlib import Path
+from typing import List
+
+import jwt
+import uvicorn
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from fastapi import FastAPI
+
+PEM_SEPARATOR = "\n\n"
+
+
+class FakeJWKS:
+    """RSA signing keys, the last one signing the new tokens."""
+
+    def __init__(self, key_file=None):
+        """
+        :param key_file: PEM file of the keys, shared with the processes
+            minting tokens (e.g. the load tests). Created if missing.
+        """
+        self.key_file = Path(key_file) if key_file else None
+        self.keys: List[tuple] = []
+        if self.key_file and self.key_file.exists():
+            for pem in self.key_file.read_text().split(PEM_SEPARATOR):
+                if pem.strip():
+                    kid, _, pem = pem.strip().partition("\n")
+                    self.keys.append(
+                        (kid, serialization.load_pem_private_key(pem.encode(), None))
+                    )
+        if not self.keys:
+            self.rotate()
+
+    def rotate(self) -> str:
+        """Adds a new signing key, and returns its kid."""
+        kid = uuid.uuid4().hex
+        self.keys.append(
+            (kid, rsa.generate_private_key(public_exponent=65537, key_size=2048))
+        )
+        if self.key_file:
+            self.key_file.write_text(
+                PEM_SEPARATOR.join(
+                    kid
+                    + "\n"
+                    + key.private_bytes(
+                        serialization.Encoding.PEM,
+                        serialization.PrivateFormat.PKCS8,
+                        serialization.NoEncryption(),
+                    ).decode()
+                    for kid, key in self.keys
+                )
+            )
+        return kid
+
+    def jwks(self) -> dict:
+        keys = []
+        for kid, key in self.keys:
+            jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(key.public_key()))
+            keys.append({**jwk, "kid": kid, "alg": "RS256", "use": "sig"})
+        return {"keys": keys}
+
+    def mint_token(
+        self, issuer: str, audience: str, sub: str = None, ttl: int = 3600, **claims
+    ) -> str:
+        """Mints a Cognito-like ID token signed with the last key."""
+        kid, key = self.keys[-1]
+        now = int(time.time())
+        payload = {
+            "sub": sub or str(uuid.uuid4()),
+            "aud": audience,
+            "iss": issuer,
+            "iat": now,
+            "exp": now + ttl,
+            "token_use": "id",
+            **claims,
+        }
+        return jwt.encode(payload, key, algorithm="RS256", headers={"kid": kid})
+
+
+def create_app(fake_jwks: FakeJWKS) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/.well-known/jwks.json")
+    async def jwks():
+        return fake_jwks.jwks()
+
+    @app.post("/rotate")
+    async def rotate():
+        return {"kid": fake_jwks.rotate()}
+
+    return app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8002)
+    parser.add_argument("--key-file", default="./fake_jwks.pem")
+    args = parser.parse_args(argv)
+
+    uvicorn.run(create_app(FakeJWKS(args.key_file)), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""Local fake LLM with an OpenAI-compatible API, to benchmark the real
+`app_b2c` pipeline offline.
+
+The answer only depends on the messages, so that the runs are repeatable, and
+is streamed at a configurable time to first token and tokens per second. A
+seeded fraction of the requests fail with a 500 or 429 error.
+
+Example:
+
+    python -m rag.fakes.llm --port 8001 --time-to-first-token 0.3 \\
+        --tokens-per-second 40 --error-rate 0.01
+
+and point the chatbot to it with `base_url: http://localhost:8001/v1` in
+`openai_config.yml` (or `OPENAI_BASE_URL` in the `.env` file).
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import re
+import time
+import uuid
+from typing import List
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from rag.config import FakeLLMConfig
+from rag.chatbot.dummy_answer import (
+    ANSWER_1,
+    ANSWER_2,
+    ANSWER_3,
+    ANSWER_7,
+    ANSWER_8,
+)
+
+ANSWERS = [ANSWER_1, ANSWER_2, ANSWER_3, ANSWER_7, ANSWER_8]
+
+# A token is a word with its leading whitespace, close enough to the BPE
+# tokens of the OpenAI models for load tests
+TOKEN_PATTERN = re.compile(r"\s*\S+")
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text)
+
+
+def count_prompt_tokens(messages: List[dict]) -> int:
+    return (
+        sum(3 + len(tokenize(str(message.get("content", "")))) for message in messages)
+        + 3
+    )
+
+
+def select_answer(messages: List[dict]) -> str:
+    """Selects the answer from a hash of the messages."""
+    digest = hashlib.sha256(json.dumps(messages, sort_keys=True).encode("utf-8"))
+    return ANSWERS[int(digest.hexdigest(), 16) % len(ANSWERS)]
+
+
+def create_app(config: FakeLLMConfig) -> FastAPI:
+    app = FastAPI()
+    rng = random.Random(config.seed)
+
+    def error_response():
+        status_code = rng.choice([429, 500])
+        return JSONResponse(
+            status_code=status_code,
+            content={
+                "error": {
+                    "message": f"Fake LLM error {status_code}",
+                    "type": (
+                        "rate_limit_error" if status_code == 429 else "server_error"
+                    ),
+                    "code": None,
+                }
+            },
+        )
+
+    @app.get("/v1/models")
+    async def models():
+        return {"object": "list", "data": [{"id": "fake", "object": "model"}]}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        if rng.random() < config.error_rate:
+            return error_response()
+
+        messages = body.get("messages", [])
+        model = body.get("model", "fake")
+        tokens = tokenize(select_answer(messages))
+        if body.get("max_tokens"):
+            tokens = tokens[: body["max_tokens"]]
+        prompt_tokens = count_prompt_tokens(messages)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(tokens),
+            "total_tokens": prompt_tokens + len(tokens),
+        }
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+
+        if not body.get("stream"):
+            await asyncio.sleep(
+                config.time_to_first_token + len(tokens) / config.tokens_per_second
+            )
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": "".join(tokens)},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": usage,
+            }
+
+        include_usage = (body.get("stream_options") or {}).get("include_usage")
+
+        def event(**fields) -> str:
+            data = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                **fields,
+            }
+            return f"data: {json.dumps(data)}\n\n"
+
+        def chunk(delta: dict, finish_reason=None) -> str:
+            return event(
+                choices=[{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+            )
+
+        async def stream():
+            start = time.perf_counter()
+            await asyncio.sleep(config.time_to_first_token)
+            yield chunk({"role": "assistant", "content": ""})
+            for i, token in enumerate(tokens):
+                # Paced from the start so that the sleeps do not drift
+                delay = (
+                    start
+                    + config.time_to_first_token
+                    + i / config.tokens_per_second
+                    - time.perf_counter()
+                )
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                yield chunk({"content": token})
+            yield chunk({}, finish_reason="stop")
+            if include_usage:
+                yield event(choices=[], usage=usage)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    return app
+
+
+def main(argv=None):
+    defaults = FakeLLMConfig.load_from_env()
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument(
+        "--time-to-first-token", type=float, default=defaults.time_to_first_token
+    )
+    parser.add_argument(
+        "--tokens-per-second", type=float, default=defaults.tokens_per_second
+    )
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    args = parser.parse_args(argv)
+
+    config = FakeLLMConfig(
+        time_to_first_token=args.time_to_first_token,
+        tokens_per_second=args.tokens_per_second,
+        error_rate=args.error_rate,
+        seed=args.seed,
+    )
+    uvicorn.run(create_app(config), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
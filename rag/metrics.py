@@ -0,0 +1,14 @@
+import os
+
+
+def metrics_app():
+    """ASGI app of the Prometheus metrics, aggregated over the workers when
+    served by `rag.serve` (see `rag.serve.setup_metrics_dir`)."""
+    from prometheus_client import CollectorRegistry, make_asgi_app, multiprocess
+
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return make_asgi_app()
+
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return make_asgi_app(registry)
@@ -0,0 +1,378 @@
+import os
+import sys
+import hmac
+import json
+import time
+import uuid
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import Counter, OrderedDict
+from typing import Optional, Tuple
+
+from rag.config import ProfilerConfig
+
+logger = logging.getLogger(__name__)
+
+# Signed profiling requests are valid for at most this many seconds
+SIGNATURE_MAX_AGE = 300
+
+SPEEDSCOPE_SCHEMA = "https://www.speedscope.app/file-format-schema.json"
+
+
+def _format_frame(frame) -> Tuple[str, str, int]:
+    code = frame.f_code
+    # `;` separates the frames of the collapsed stacks
+    name = f"{code.co_qualname} ({os.path.basename(code.co_filename)})"
+    return name.replace(";", ":"), code.co_filename, code.co_firstlineno
+
+
+def _thread_stack(frame) -> tuple:
+    stack = []
+    while frame is not None:
+        stack.append(_format_frame(frame))
+        frame = frame.f_back
+    return tuple(reversed(stack))
+
+
+def _await_stack(task: asyncio.Task) -> Optional[tuple]:
+    """Returns the chain of coroutines awaited by the task, root first, or
+    `None` if the task is running (it is then in the stack of its thread)."""
+    coro = task.get_coro()
+    if getattr(coro, "cr_running", False):
+        return None
+    stack = []
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            break
+        stack.append(_format_frame(frame))
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    return tuple(stack)
+
+
+class Profile:
+    """Aggregated stack samples of a request, exported as collapsed stacks
+    (flamegraph.pl, inferno) or as a speedscope file."""
+
+    def __init__(self, profile_id: str, name: str, interval: float):
+        self.profile_id = profile_id
+        self.name = name
+        self.interval = interval
+        self.duration = 0.0
+        # stack -> number of samples, for every thread and for the request task
+        self.samples = {}
+
+    def add(self, track: str, stack: tuple):
+        self.samples.setdefault(track, Counter())[stack] += 1
+
+    def to_collapsed(self) -> str:
+        lines = []
+        for track, stacks in self.samples.items():
+            for stack, count in stacks.items():
+                frames = ";".join([track, *(name for name, _, _ in stack)])
+                lines.append(f"{frames} {count}")
+        return "\n".join(lines) + "\n"
+
+    def to_speedscope(self) -> dict:
+        frames, index = [], {}
+        profiles = []
+        for track, stacks in self.samples.items():
+            samples, weights = [], []
+            for stack, count in stacks.items():
+                sample = []
+                for frame in stack:
+                    if frame not in index:
+                        index[frame] = len(frames)
+                        name, file, line = frame
+                        frames.append({"name": name, "file": file, "line": line})
+                    sample.append(index[frame])
+                samples.append(sample)
+                weights.append(count * self.interval)
+            profiles.append(
+                {
+                    "type": "sampled",
+                    "name": track,
+                    "unit": "seconds",
+                    "startValue": 0,
+                    "endValue": sum(weights),
+                    "samples": samples,
+                    "weights": weights,
+                }
+            )
+        return {
+            "$schema": SPEEDSCOPE_SCHEMA,
+            "name": self.name,
+            "exporter": "rag.profiling",
+            "activeProfileIndex": 0,
+            "shared": {"frames": frames},
+            "profiles": profiles,
+        }
+
+
+class SamplingProfiler:
+    """
+    Wall-clock sampling profiler running in a background thread.
+
+    Every `interval` seconds it records the stack of every thread of the
+    process and, if given, the chain of coroutines awaited by the request
+    task, so that the time an async request spends waiting (on the LLM, the
+    database) is attributed to the awaiting code. The thread stacks also
+    contain the requests running concurrently on the same event loop.
+    """
+
+    def __init__(
+        self,
+        profile: Profile,
+        task: Optional[asyncio.Task] = None,
+        max_duration: float = 30.0,
+    ):
+        self.profile = profile
+        self.task = task
+        self.max_duration = max_duration
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="request-profiler", daemon=True
+        )
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id != own_id:
+                track = f"thread {names.get(thread_id, thread_id)}"
+                self.profile.add(track, _thread_stack(frame))
+        if self.task is not None and not self.task.done():
+            stack = _await_stack(self.task)
+            if stack:
+                self.profile.add("request task", stack)
+
+    def _run(self):
+        start = time.perf_counter()
+        deadline = start + self.max_duration
+        while not self._stopped.wait(self.profile.interval):
+            if time.perf_counter() > deadline:
+                logger.warning(
+                    "Profile %s stopped after %.0f s",
+                    self.profile.profile_id,
+                    self.max_duration,
+                )
+                break
+            self._sample()
+        self.profile.duration = time.perf_counter() - start
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self) -> Profile:
+        self._stopped.set()
+        self._thread.join()
+        return self.profile
+
+
+class ProfileStore:
+    """Keeps the last profiles in memory, and optionally writes them to a
+    directory as speedscope files."""
+
+    def __init__(self, max_profiles: int = 20, output_dir: Optional[str] = None):
+        self.max_profiles = max_profiles
+        self.output_dir = output_dir
+        self._profiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def save(self, profile: Profile):
+        with self._lock:
+            self._profiles[profile.profile_id] = profile
+            while len(self._profiles) > self.max_profiles:
+                self._profiles.popitem(last=False)
+
+        if self.output_dir:
+            os.makedirs(self.output_dir, exist_ok=True)
+            path = os.path.join(
+                self.output_dir, f"{profile.profile_id}.speedscope.json"
+            )
+            with open(path, "w") as fo:
+                json.dump(profile.to_speedscope(), fo)
+
+    def get(self, profile_id: str) -> Optional[Profile]:
+        with self._lock:
+            return self._profiles.get(profile_id)
+
+
+def sign_profile_request(
+    secret: str, method: str, path: str, expires: Optional[int] = None
+) -> str:
+    """Returns the `X-Profile-Signature` header authorizing to profile (or to
+    get the profile of) a request: `<expiry timestamp>.<HMAC-SHA256>`."""
+    if expires is None:
+        expires = int(time.time()) + SIGNATURE_MAX_AGE
+    message = f"{expires}:{method.upper()}:{path}".encode("utf-8")
+    digest = hmac.new(secret.encode("utf-8"), message, hashlib.sha256).hexdigest()
+    return f"{expires}.{digest}"
+
+
+def verify_profile_signature(
+    secret: str, method: str, path: str, signature: str
+) -> bool:
+    expires, _, _ = signature.partition(".")
+    try:
+        expires = int(expires)
+    except ValueError:
+        return False
+    now = time.time()
+    if not now <= expires <= now + SIGNATURE_MAX_AGE:
+        return False
+    expected = sign_profile_request(secret, method, path, expires)
+    return hmac.compare_digest(expected, signature)
+
+
+class RequestProfiler:
+    """
+    Profiles the requests carrying an `X-Profile` header, if they are
+    authorized: a bearer token of a user of the admin Cognito group, or an
+    `X-Profile-Signature` header signed with the profiler secret (see
+    `sign_profile_request`). Other requests run unprofiled.
+
+    Only one request is profiled at a time, and at most one every
+    `min_interval` seconds, so that profiling cannot degrade the service.
+    """
+
+    def __init__(self, config: ProfilerConfig):
+        self.config = config
+        self.store = ProfileStore(config.max_profiles, config.output_dir)
+        self._active = False
+        self._last_start = float("-inf")
+
+    async def authorize(self, headers, method: str, path: str) -> bool:
+        signature = headers.get("x-profile-signature")
+        if signature and self.config.secret:
+            return verify_profile_signature(self.config.secret, method, path, signature)
+
+        scheme, _, token = headers.get("authorization", "").partition(" ")
+        if scheme.lower() != "bearer" or not token:
+            return False
+
+        from fastapi.security import HTTPAuthorizationCredentials
+        from rag.auth import decode_token, fetch_cognito_keys, require_admin
+
+        credentials = HTTPAuthorizationCredentials(scheme=scheme, credentials=token)
+        try:
+            payload = await decode_token(credentials, await fetch_cognito_keys())
+            await require_admin(payload)
+        except Exception:
+            return False
+        return True
+
+    def acquire(self) -> bool:
+        """Reserves the profiler for a request, if none is running and the
+        last one started more than `min_interval` seconds ago."""
+        now = time.monotonic()
+        if self._active or now - self._last_start < self.config.min_interval:
+            return False
+        self._active = True
+        self._last_start = now
+        return True
+
+    def release(self):
+        self._active = False
+
+    def start(self, name: str) -> SamplingProfiler:
+        profile = Profile(uuid.uuid4().hex, name, self.config.interval)
+        sampler = SamplingProfiler(
+            profile, task=asyncio.current_task(), max_duration=self.config.max_duration
+        )
+        sampler.start()
+        return sampler
+
+    def finish(self, sampler: SamplingProfiler):
+        profile = sampler.stop()
+        try:
+            self.store.save(profile)
+        except OSError:
+            logger.exception("Could not write the profile %s", profile.profile_id)
+        finally:
+            self.release()
+        logger.info(
+            "Profile %s of %s: %.3f s",
+            profile.profile_id,
+            profile.name,
+            profile.duration,
+        )
+
+
+class ProfilingMiddleware:
+    """ASGI middleware running the `RequestProfiler` on the requests asking
+    for it. The profile id is returned in the `X-Profile-Id` header, or the
+    reason why the request was not profiled in `X-Profile-Skipped`."""
+
+    def __init__(self, app, profiler: RequestProfiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.profiler.config.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        headers = {
+            name.decode("latin-1").lower(): value.decode("latin-1")
+            for name, value in scope["headers"]
+        }
+        if "x-profile" not in headers:
+            await self.app(scope, receive, send)
+            return
+
+        method, path = scope["method"], scope["path"]
+        if not await self.profiler.authorize(headers, method, path):
+            logger.warning("Unauthorized profiling request of %s %s", method, path)
+            await self._call_skipped(scope, receive, send, "unauthorized")
+            return
+        if not self.profiler.acquire():
+            await self._call_skipped(scope, receive, send, "rate-limited")
+            return
+
+        sampler = self.profiler.start(f"{method} {path}")
+        finished = False
+
+        async def finish():
+            nonlocal finished
+            if not finished:
+                finished = True
+                # Joins the sampler and writes the profile off the event loop
+                await asyncio.to_thread(self.profiler.finish, sampler)
+
+        async def send_with_profile(message):
+            if message["type"] == "http.response.start":
+                message = {
+                    **message,
+                    "headers": [
+                        *message.get("headers", []),
+                        (b"x-profile-id", sampler.profile.profile_id.encode()),
+                    ],
+                }
+            await send(message)
+            # The background tasks run after the response is sent, out of it
+            if message["type"] == "http.response.body" and not message.get(
+                "more_body", False
+            ):
+                await finish()
+
+        try:
+            await self.app(scope, receive, send_with_profile)
+        finally:
+            await finish()
+
+    async def _call_skipped(self, scope, receive, send, reason: str):
+        async def send_with_reason(message):
+            if message["type"] == "http.response.start":
+                message = {
+                    **message,
+                    "headers": [
+                        *message.get("headers", []),
+                        (b"x-profile-skipped", reason.encode()),
+                    ],
+                }
+            await send(message)
+
+        await self.app(scope, receive, send_with_reason)
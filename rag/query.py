@@ -1,3 +1,4 @@
+import os
 import pandas as pd
 from sqlalchemy import create_engine
 
@@ -7,10 +8,13 @@ from sqlalchemy.sql import func
 from dotenv import load_dotenv
 import logging
 
+from rag.tracing import instrument_engine
+from rag.query_stats import track_engine
 from rag.datamodels import (
     User,
     Conversation,
     ConversationMessage,
+    ConversationSummary,
     UserInsurance,
     Package,
     PackageLanguage,
@@ -25,10 +29,14 @@ class QueryConversations:
     def __init__(self, connection_string: str):
         try:
             self.engine = create_engine(connection_string)
+            instrument_engine(self.engine)
+            track_engine(self.engine)
             Session = sessionmaker(bind=self.engine)
             self.session = Session()
             Base.metadata.create_all(self.engine)
             self.insert_dummy_data()
+            # The connections must not be shared with forked workers
+            os.register_at_fork(before=self.release_connections)
 
         except Exception as error:
             logger.error(error)
@@ -89,6 +97,11 @@ class QueryConversations:
             ConversationMessage.conversation_uuid == conversation_uuid
         ).delete()
 
+        # Then its rolling summary
+        self.session.query(ConversationSummary).filter(
+            ConversationSummary.conversation_uuid == conversation_uuid
+        ).delete()
+
         # Now delete the conversation itself
         result = (
             self.session.query(Conversation)
@@ -196,3 +209,8 @@ class QueryConversations:
 
     def close(self):
         self.session.close()
+
+    def release_connections(self):
+        """Closes the pooled connections, reopened on use."""
+        self.session.close()
+        self.engine.dispose()
@@ -0,0 +1,230 @@
+import re
+import time
+import hashlib
+import logging
+import threading
+from functools import lru_cache
+from typing import Callable, List, Optional
+
+import psycopg
+from sqlalchemy import event
+
+from rag.config import QueryStatsConfig
+
+logger = logging.getLogger(__name__)
+
+# Fingerprint of the statements beyond `max_fingerprints`
+OTHER_FINGERPRINT = "<other>"
+
+# Weight of the last call in the recent mean time of a statement
+RECENT_MEAN_WEIGHT = 0.1
+
+EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+_FINGERPRINT_PATTERNS = [
+    (re.compile(r"'(?:[^']|'')*'"), "?"),
+    (re.compile(r"%\(\w+\)s|%s|\$\d+"), "?"),
+    (re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b"), "?"),
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)"), "(?)"),
+    (re.compile(r"\s+"), " "),
+]
+
+
+@lru_cache(maxsize=1024)
+def fingerprint(statement: str) -> str:
+    """Normalizes the statement so that its executions with different
+    parameters are aggregated: literals and placeholders are replaced with `?`
+    and the lists of values collapsed."""
+    for pattern, replacement in _FINGERPRINT_PATTERNS:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip()
+
+
+class QueryStats:
+    """
+    Aggregates the executions of the SQL statements by fingerprint: number of
+    calls, total, max and recent mean time, and rows returned or changed.
+
+    The statements slower than `slow_query_threshold` are logged with their
+    `EXPLAIN` plan, at most once every `explain_interval` seconds for the same
+    statement. The plan is computed without running the statement again.
+    """
+
+    def __init__(
+        self,
+        slow_query_threshold: float = 0.1,
+        explain: bool = True,
+        explain_interval: float = 60.0,
+        max_fingerprints: int = 500,
+    ):
+        self.slow_query_threshold = slow_query_threshold
+        self.explain = explain
+        self.explain_interval = explain_interval
+        self.max_fingerprints = max_fingerprints
+        self._stats = {}
+        self._last_explain = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: QueryStatsConfig) -> "QueryStats":
+        return cls(**config.model_dump())
+
+    def record(
+        self,
+        statement: str,
+        elapsed: float,
+        rows: int,
+        explain: Optional[Callable[[], str]] = None,
+    ) -> None:
+        key = fingerprint(statement)
+        rows = max(rows, 0)
+        with self._lock:
+            if key not in self._stats and len(self._stats) >= self.max_fingerprints:
+                key = OTHER_FINGERPRINT
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = {
+                    "calls": 0,
+                    "total_time": 0.0,
+                    "max_time": 0.0,
+                    "recent_mean_time": elapsed,
+                    "rows": 0,
+                    "max_rows": 0,
+                    "slow_calls": 0,
+                }
+            stats["calls"] += 1
+            stats["total_time"] += elapsed
+            stats["max_time"] = max(stats["max_time"], elapsed)
+            stats["recent_mean_time"] += RECENT_MEAN_WEIGHT * (
+                elapsed - stats["recent_mean_time"]
+            )
+            stats["rows"] += rows
+            stats["max_rows"] = max(stats["max_rows"], rows)
+
+            slow = elapsed > self.slow_query_threshold
+            if slow:
+                stats["slow_calls"] += 1
+            run_explain = (
+                slow
+                and self.explain
+                and explain is not None
+                and key != OTHER_FINGERPRINT
+                and statement.lstrip().upper().startswith(EXPLAINABLE)
+                and time.monotonic() - self._last_explain.get(key, float("-inf"))
+                > self.explain_interval
+            )
+            if run_explain:
+                self._last_explain[key] = time.monotonic()
+
+        if not slow:
+            return
+        plan = None
+        if run_explain:
+            try:
+                plan = explain()
+            except Exception as e:
+                plan = f"EXPLAIN failed: {e}"
+        logger.warning(
+            "Slow query (%.3f s, %d rows): %s%s",
+            elapsed,
+            rows,
+            key,
+            f"\n{plan}" if plan else "",
+        )
+
+    def snapshot(self, sort: str = "total_time", limit: int = 50) -> List[dict]:
+        """Returns the statistics of the statements, sorted in decreasing
+        order of `sort`."""
+        with self._lock:
+            items = [(key, dict(stats)) for key, stats in self._stats.items()]
+        result = []
+        for key, stats in items:
+            fingerprint_id = hashlib.sha1(key.encode("utf-8")).hexdigest()[:12]
+            result.append(
+                {
+                    "fingerprint_id": fingerprint_id,
+                    "statement": key,
+                    **stats,
+                    "mean_time": stats["total_time"] / stats["calls"],
+                    "mean_rows": stats["rows"] / stats["calls"],
+                }
+            )
+        result.sort(key=lambda item: item[sort], reverse=True)
+        return result[:limit]
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats.clear()
+            self._last_explain.clear()
+
+
+query_stats = QueryStats.from_config(QueryStatsConfig.load_from_env())
+
+
+def track_engine(engine, stats: QueryStats = query_stats) -> None:
+    """Records the statements executed by the SQLAlchemy engine. The plans of
+    the slow ones are computed on another connection of the pool, so that the
+    transaction of the statement is not affected if `EXPLAIN` fails."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def start_timer(conn, cursor, statement, parameters, context, executemany):
+        context._query_start = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def record(conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, "_query_start", None)
+        if start is None or context.execution_options.get("explain"):
+            return
+
+        def explain() -> str:
+            with engine.connect() as connection:
+                result = connection.execution_options(explain=True).exec_driver_sql(
+                    f"EXPLAIN {statement}", parameters
+                )
+                return "\n".join(row[0] for row in result)
+
+        stats.record(
+            statement,
+            time.perf_counter() - start,
+            cursor.rowcount,
+            explain=None if executemany else explain,
+        )
+
+
+class StatsCursor(psycopg.Cursor):
+    """psycopg cursor recording its statements in `query_stats`. Used with
+    `psycopg.connect(..., cursor_factory=StatsCursor)`."""
+
+    stats = query_stats
+
+    def _statement(self, query) -> str:
+        if isinstance(query, (bytes, str)):
+            return query.decode() if isinstance(query, bytes) else query
+        return query.as_string(self)
+
+    def _explain(self, query, params) -> str:
+        # In a savepoint, so that a failed EXPLAIN does not abort the
+        # transaction of the statement
+        with self.connection.transaction():
+            with psycopg.Cursor(self.connection) as cursor:
+                cursor.execute(f"EXPLAIN {self._statement(query)}", params)
+                return "\n".join(row[0] for row in cursor.fetchall())
+
+    def execute(self, query, params=None, **kwargs):
+        start = time.perf_counter()
+        result = super().execute(query, params, **kwargs)
+        self.stats.record(
+            self._statement(query),
+            time.perf_counter() - start,
+            self.rowcount,
+            explain=lambda: self._explain(query, params),
+        )
+        return result
+
+    def executemany(self, query, params_seq, **kwargs):
+        start = time.perf_counter()
+        result = super().executemany(query, params_seq, **kwargs)
+        self.stats.record(
+            self._statement(query), time.perf_counter() - start, self.rowcount
+        )
+        return result
@@ -0,0 +1,253 @@
+"""Shared embedding and retrieval service.
+
+A single process owns the sentence-transformer and the Chroma index, and
+serves the retrieval of the API workers over a Unix socket (or local HTTP),
+so that the workers do not load their own copies. The embeddings of the
+questions of concurrent requests, from all the workers, are computed in one
+batch.
+
+Example:
+
+    python -m rag.retrieval_service --socket /tmp/rag-retrieval.sock
+
+and set `RETRIEVAL_SERVICE_SOCKET_PATH=/tmp/rag-retrieval.sock` for the API,
+whose `VectorZurichChromaDbClient` then calls the service.
+"""
+
+import os
+import asyncio
+import argparse
+import logging
+from typing import Callable, List, Optional
+
+import uvicorn
+from fastapi import FastAPI
+from prometheus_client import Histogram, make_asgi_app
+from pydantic import BaseModel, Field
+
+from rag.config import RetrievalServiceConfig
+from rag.constants import DB_PATH, COLLECTION_NAME
+
+logger = logging.getLogger(__name__)
+
+RETRIEVAL_EMBEDDING_BATCH_SIZE = Histogram(
+    "retrieval_embedding_batch_size",
+    "Number of texts embedded in one batch by the retrieval service",
+    buckets=(1, 2, 4, 8, 16, 32, 64),
+)
+
+
+class EmbeddingBatcher:
+    """
+    Embeds the texts of the concurrent requests in batches: a batch is run as
+    soon as it holds `max_batch_size` texts, or `max_wait` seconds after its
+    first request. The model runs in a thread, off the event loop.
+    """
+
+    def __init__(
+        self,
+        embed: Callable[[List[str]], List[List[float]]],
+        max_batch_size: int = 32,
+        max_wait: float = 0.005,
+    ):
+        self.embed_texts = embed
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = None
+        self._task = None
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def embed(self, texts: List[str]) -> List[List[float]]:
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((texts, future))
+        return await future
+
+    async def _next_batch(self) -> list:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        size = len(batch[0][0])
+        deadline = loop.time() + self.max_wait
+        while size < self.max_batch_size:
+            try:
+                item = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            texts = [text for item_texts, _ in batch for text in item_texts]
+            RETRIEVAL_EMBEDDING_BATCH_SIZE.observe(len(texts))
+            try:
+                embeddings = await asyncio.to_thread(self.embed_texts, texts)
+            except Exception as e:
+                logger.exception("Embedding of a batch of %d texts failed", len(texts))
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            offset = 0
+            for item_texts, future in batch:
+                if not future.done():
+                    future.set_result(embeddings[offset : offset + len(item_texts)])
+                offset += len(item_texts)
+
+
+class EmbedRequest(BaseModel):
+    texts: List[str] = Field(min_length=1)
+
+
+class PackageChunksRequest(BaseModel):
+    filter_packages: dict
+    top_k: int = Field(ge=1)
+    user_question: str
+    # Embedded by the service if not given
+    query_embedding: Optional[List[float]] = None
+
+
+def _to_json(chunks: dict) -> dict:
+    # The stored embeddings may be numpy arrays
+    return {
+        "ids": list(chunks["ids"]),
+        "documents": list(chunks["documents"]),
+        "embeddings": [
+            [float(value) for value in embedding] for embedding in chunks["embeddings"]
+        ],
+    }
+
+
+def create_app(retriever, config: RetrievalServiceConfig) -> FastAPI:
+    """
+    Serves the retrieval of a local `VectorZurichChromaDbClient`.
+
+    Args:
+        retriever (VectorZurichChromaDbClient): the client owning the model
+        and the index.
+        config (RetrievalServiceConfig): the batching of the embeddings.
+    """
+    app = FastAPI()
+    app.mount("/metrics", make_asgi_app())
+    batcher = EmbeddingBatcher(
+        retriever.embed_texts,
+        max_batch_size=config.max_batch_size,
+        max_wait=config.max_wait,
+    )
+
+    @app.on_event("startup")
+    def start_batcher():
+        batcher.start()
+
+    @app.on_event("shutdown")
+    async def stop_batcher():
+        await batcher.stop()
+
+    @app.get("/health")
+    async def health():
+        return {"status": "ok"}
+
+    @app.post("/embed")
+    async def embed(request: EmbedRequest):
+        return {"embeddings": await batcher.embed(request.texts)}
+
+    @app.post("/package_chunks")
+    async def package_chunks(request: PackageChunksRequest):
+        query_embedding = request.query_embedding
+        if query_embedding is None:
+            query_embedding = (await batcher.embed([request.user_question]))[0]
+        chunks = await asyncio.to_thread(
+            retriever.get_zurich_package_chunks,
+            filter_packages=request.filter_packages,
+            top_k=request.top_k,
+            user_question=request.user_question,
+            query_embedding=query_embedding,
+        )
+        return _to_json(chunks)
+
+    @app.get("/collection_version")
+    async def collection_version():
+        return {
+            "version": await asyncio.to_thread(lambda: retriever.collection_version)
+        }
+
+    @app.get("/general_condition_chunks")
+    async def general_condition_chunks():
+        def get():
+            # The version first, so that a re-ingest in between is seen by
+            # the clients at their next call
+            version = retriever.collection_version
+            return version, retriever.get_zurich_general_condition_chunks()
+
+        version, chunks = await asyncio.to_thread(get)
+        return {"version": version, "chunks": _to_json(chunks)}
+
+    return app
+
+
+def main(argv=None):
+    defaults = RetrievalServiceConfig.load_from_env()
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--socket", default=defaults.socket_path)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8010)
+    parser.add_argument("--db-path", default=DB_PATH)
+    parser.add_argument("--collection-name", default=COLLECTION_NAME)
+    parser.add_argument("--max-batch-size", type=int, default=defaults.max_batch_size)
+    parser.add_argument("--max-wait", type=float, default=defaults.max_wait)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    from rag.utils import sentence_transformer_ef
+    from rag.chatbot.retriever import VectorZurichChromaDbClient
+    from rag.chatbot.reranker import CrossEncoderReranker
+
+    retriever = VectorZurichChromaDbClient.get_retriever(
+        db_path=args.db_path,
+        collection_name=args.collection_name,
+        embeddings=sentence_transformer_ef,
+        reranker=(
+            CrossEncoderReranker()
+            if os.getenv("RERANK_ENABLED", "false").lower() == "true"
+            else None
+        ),
+    )
+    retriever.warm_up()
+
+    config = RetrievalServiceConfig(
+        socket_path=args.socket,
+        max_batch_size=args.max_batch_size,
+        max_wait=args.max_wait,
+    )
+    app = create_app(retriever, config)
+    if args.socket:
+        # Left by a previous run
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        uvicorn.run(app, uds=args.socket)
+    else:
+        uvicorn.run(app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
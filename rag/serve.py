@@ -0,0 +1,238 @@
+"""Production server of the chatbot.
+
+Imports the app once in the parent process, loading the sentence-transformer
+models and the Chroma index, then forks the workers so that their memory is
+shared copy-on-write. On SIGTERM (or SIGINT) the workers stop accepting
+connections and finish their in-flight requests before exiting.
+
+Example:
+
+    python -m rag.serve --app b2c --workers 4 --port 80
+"""
+
+import gc
+import os
+import sys
+import glob
+import time
+import signal
+import logging
+import argparse
+import tempfile
+import importlib
+
+from dotenv import load_dotenv
+
+from rag.constants import SERVER_THREADS_PER_WORKER
+
+logger = logging.getLogger(__name__)
+
+APPS = {"b2c": "rag.app_b2c", "dummy": "rag.dummy_app_b2c"}
+
+# Read by the OpenMP, MKL, OpenBLAS and numexpr runtimes when they are loaded
+THREAD_VARIABLES = (
+    "OMP_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+)
+
+# Exit code of a worker whose app failed to start
+STARTUP_FAILURE = 3
+
+# Seconds before restarting a worker that exited right after its start
+RESTART_BACKOFF = 1.0
+
+
+def limit_threads(threads: int) -> None:
+    """Caps the threads of the numerical libraries. Must be called before they
+    are imported."""
+    for name in THREAD_VARIABLES:
+        os.environ[name] = str(threads)
+
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        torch.set_num_threads(threads)
+
+
+def setup_metrics_dir() -> None:
+    """Enables the multiprocess mode of the Prometheus client, so that
+    `/metrics` aggregates the metrics of all the workers. Must be called
+    before `prometheus_client` is imported."""
+    path = os.environ.setdefault(
+        "PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "rag-metrics")
+    )
+    os.makedirs(path, exist_ok=True)
+    # Metrics of a previous run
+    for file_path in glob.glob(os.path.join(path, "*.db")):
+        os.remove(file_path)
+
+
+class Supervisor:
+    """Forks the workers serving the app on a shared socket, restarts the ones
+    that exit, and stops them gracefully on SIGTERM."""
+
+    def __init__(self, app, config, sockets):
+        self.app = app
+        self.config = config
+        self.sockets = sockets
+        # pid -> (worker index, start time)
+        self.workers = {}
+        self._stopping = False
+
+    def _run_worker(self) -> int:
+        import uvicorn
+
+        # Replaced by the handlers of uvicorn, which drain the connections
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        limit_threads(self.config.threads_per_worker)
+
+        server = uvicorn.Server(
+            uvicorn.Config(
+                self.app,
+                lifespan="on",
+                timeout_graceful_shutdown=int(self.config.graceful_timeout),
+            )
+        )
+        server.run(sockets=self.sockets)
+        return 0 if server.started else STARTUP_FAILURE
+
+    def spawn(self, index: int) -> None:
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 1
+            try:
+                exit_code = self._run_worker()
+            except BaseException:
+                logger.exception("Worker %d failed", index)
+            finally:
+                os._exit(exit_code)
+
+        self.workers[pid] = (index, time.monotonic())
+        logger.info("Started worker %d (pid %d)", index, pid)
+
+    def _reap(self) -> list:
+        """Returns the index of the workers that exited, and how long they ran."""
+        exited = []
+        while self.workers:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            if pid not in self.workers:
+                continue
+            index, start = self.workers.pop(pid)
+            self._mark_dead(pid)
+            exit_code = os.waitstatus_to_exitcode(status)
+            if not self._stopping:
+                logger.error(
+                    "Worker %d (pid %d) exited with code %d", index, pid, exit_code
+                )
+            exited.append((index, time.monotonic() - start))
+        return exited
+
+    @staticmethod
+    def _mark_dead(pid: int) -> None:
+        if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+            from prometheus_client import multiprocess
+
+            multiprocess.mark_process_dead(pid)
+
+    def _request_stop(self, signum, frame) -> None:
+        logger.info("Received %s, stopping the workers", signal.Signals(signum).name)
+        self._stopping = True
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+
+        for index in range(self.config.workers):
+            self.spawn(index)
+
+        while not self._stopping:
+            for index, uptime in self._reap():
+                if self._stopping:
+                    break
+                if uptime < RESTART_BACKOFF:
+                    time.sleep(RESTART_BACKOFF)
+                self.spawn(index)
+            time.sleep(0.2)
+
+        self.stop()
+
+    def stop(self) -> None:
+        for pid in self.workers:
+            os.kill(pid, signal.SIGTERM)
+
+        # The workers finish their requests, then run the shutdown hooks
+        deadline = time.monotonic() + self.config.graceful_timeout + 10
+        while self.workers and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.1)
+
+        for pid in list(self.workers):
+            logger.warning("Killing worker pid %d", pid)
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            self.workers.pop(pid)
+            self._mark_dead(pid)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--app", choices=sorted(APPS))
+    parser.add_argument("--host")
+    parser.add_argument("--port", type=int)
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--threads-per-worker", type=int)
+    parser.add_argument("--graceful-timeout", type=float)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    # Before numpy and torch are imported by the app (and by rag.config)
+    load_dotenv()
+    limit_threads(
+        args.threads_per_worker
+        or int(os.getenv("SERVER_THREADS_PER_WORKER", SERVER_THREADS_PER_WORKER))
+    )
+    setup_metrics_dir()
+
+    from rag.config import ServerConfig
+
+    config = ServerConfig(
+        **{
+            **ServerConfig.load_from_env().model_dump(),
+            **{name: value for name, value in vars(args).items() if value is not None},
+        }
+    )
+
+    import uvicorn
+
+    # Also configures the logging
+    sock = uvicorn.Config(None, host=config.host, port=config.port).bind_socket()
+
+    # Loads the models and the indexes once, before the fork
+    module = importlib.import_module(APPS[config.app])
+    preload = getattr(module, "preload", None)
+    if preload is not None:
+        preload()
+
+    # The objects of the parent are not tracked by the garbage collector of
+    # the workers anymore, which would copy their memory pages
+    gc.collect()
+    gc.freeze()
+
+    logger.info(
+        "Serving %s on %s:%d with %d workers",
+        config.app,
+        config.host,
+        config.port,
+        config.workers,
+    )
+    Supervisor(module.app, config, [sock]).run()
+    sock.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import time
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import List, Optional, Tuple
+
+from prometheus_client import Histogram
+
+from rag.tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+STAGE_SECONDS = Histogram(
+    "request_stage_seconds",
+    "Time spent in every stage of the requests",
+    ["stage"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+
+# (stage, seconds) of the current request, set by `ServerTimingMiddleware`
+_timings: ContextVar[Optional[List[Tuple[str, float]]]] = ContextVar(
+    "timings", default=None
+)
+
+
+@contextmanager
+def stage(name: str):
+    """Times a stage of the current request, for the `Server-Timing` header and
+    the `request_stage_seconds` histogram, and traces it in a span."""
+    start = time.perf_counter()
+    try:
+        with tracer.start_as_current_span(name):
+            yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.labels(stage=name).observe(elapsed)
+        timings = _timings.get()
+        # The list is shared with the threads and the tasks of the request
+        if timings is not None:
+            timings.append((name, elapsed))
+
+
+def format_server_timing(timings: List[Tuple[str, float]], total: float) -> str:
+    metrics = [f"{name};dur={elapsed * 1000:.1f}" for name, elapsed in timings]
+    metrics.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(metrics)
+
+
+class ServerTimingMiddleware:
+    """ASGI middleware adding the timed stages of the request (see `stage`) to
+    the `Server-Timing` header of the response."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timings = []
+        token = _timings.set(timings)
+        start = time.perf_counter()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                header = format_server_timing(timings, time.perf_counter() - start)
+                message = {
+                    **message,
+                    "headers": [
+                        *message.get("headers", []),
+                        (b"server-timing", header.encode("latin-1")),
+                    ],
+                }
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _timings.reset(token)
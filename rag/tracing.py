@@ -0,0 +1,122 @@
+import logging
+import threading
+from typing import Optional, Sequence
+
+from opentelemetry import trace
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import ReadableSpan, TracerProvider
+from opentelemetry.sdk.trace.export import (
+    BatchSpanProcessor,
+    ConsoleSpanExporter,
+    SpanExporter,
+    SpanExportResult,
+)
+from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+from opentelemetry.trace import Status, StatusCode
+from sqlalchemy import event
+
+from rag.config import TracingConfig
+
+logger = logging.getLogger(__name__)
+
+# No-op until `configure_tracing` sets the tracer provider
+tracer = trace.get_tracer("rag")
+
+
+class JSONLinesSpanExporter(SpanExporter):
+    """Appends the finished spans to a file, one JSON object per line."""
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self._file = open(file_path, "a")
+        self._lock = threading.Lock()
+
+    def export(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
+        with self._lock:
+            for span in spans:
+                self._file.write(span.to_json(indent=None) + "\n")
+            self._file.flush()
+        return SpanExportResult.SUCCESS
+
+    def shutdown(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+def get_exporter(config: TracingConfig) -> SpanExporter:
+    if config.exporter == "console":
+        return ConsoleSpanExporter()
+    if config.exporter == "file":
+        return JSONLinesSpanExporter(config.file_path)
+
+    from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import (
+        OTLPSpanExporter,
+    )
+
+    return OTLPSpanExporter(endpoint=config.otlp_endpoint, insecure=True)
+
+
+def configure_tracing(config: TracingConfig, app=None) -> Optional[TracerProvider]:
+    """
+    Sets the tracer provider of the process and, if given, traces the requests
+    of the FastAPI app. The incoming `traceparent` headers are honoured, the
+    other traces are sampled with `sample_ratio`.
+    """
+    if config.exporter == "none":
+        return None
+
+    provider = TracerProvider(
+        resource=Resource.create({"service.name": config.service_name}),
+        sampler=ParentBased(TraceIdRatioBased(config.sample_ratio)),
+    )
+    provider.add_span_processor(BatchSpanProcessor(get_exporter(config)))
+    trace.set_tracer_provider(provider)
+
+    if app is not None:
+        from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
+
+        FastAPIInstrumentor.instrument_app(
+            app, tracer_provider=provider, excluded_urls="metrics"
+        )
+
+    logger.info(
+        "Tracing to %s, %.0f%% of the traces sampled",
+        config.exporter,
+        config.sample_ratio * 100,
+    )
+    return provider
+
+
+def record_error(span, error: BaseException):
+    span.record_exception(error)
+    span.set_status(Status(StatusCode.ERROR, str(error)))
+
+
+def instrument_engine(engine) -> None:
+    """Traces every statement executed by the SQLAlchemy engine, with the number
+    of rows it returned or changed. The parameters are not recorded."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def start_span(conn, cursor, statement, parameters, context, executemany):
+        context._span = tracer.start_span(
+            "db.query",
+            attributes={
+                "db.system": "postgresql",
+                "db.operation": statement.split(None, 1)[0].upper(),
+                "db.statement": statement,
+            },
+        )
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def end_span(conn, cursor, statement, parameters, context, executemany):
+        span = getattr(context, "_span", None)
+        if span is not None:
+            span.set_attribute("db.rows", cursor.rowcount)
+            span.end()
+
+    @event.listens_for(engine, "handle_error")
+    def end_span_on_error(exception_context):
+        span = getattr(exception_context.execution_context, "_span", None)
+        if span is not None:
+            record_error(span, exception_context.original_exception)
+            span.end()
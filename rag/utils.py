@@ -1,12 +1,23 @@
 import yaml
+from functools import lru_cache
 from typing import ChainMap
 from chromadb.utils import embedding_functions
 from rag.constants import MODEL_NAME
 
 
-sentence_transformer_ef = embedding_functions.SentenceTransformerEmbeddingFunction(
-    model_name=MODEL_NAME
-)
+@lru_cache(maxsize=None)
+def get_sentence_transformer_ef():
+    return embedding_functions.SentenceTransformerEmbeddingFunction(
+        model_name=MODEL_NAME
+    )
+
+
+def __getattr__(name: str):
+    # `sentence_transformer_ef` is loaded on first use, so that the processes
+    # using the retrieval service (`rag.retrieval_service`) do not load it
+    if name == "sentence_transformer_ef":
+        return get_sentence_transformer_ef()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def load_conf(*file_paths: list[str]) -> ChainMap: